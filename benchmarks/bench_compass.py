@@ -0,0 +1,54 @@
+import os
+import sys
+import timeit
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from section import parse_compass_seats
+
+PAGES_DIR = os.path.join(os.path.dirname(__file__), 'pages')
+ITERATIONS = int(os.getenv('BENCH_ITERATIONS', '2000'))
+
+# The BeautifulSoup parser the tracker used before, kept as the reference for layout checks
+def parse_soup(html: str) -> dict:
+    soup = BeautifulSoup(html, 'html.parser')
+    all_fields = soup.find_all('td', class_='dddefault')
+
+    if len(all_fields) == 0:
+        return {}
+
+    return {
+        'SEATS': {
+            'ACTUAL': int(all_fields[2].text),
+            'CAPACITY': int(all_fields[1].text),
+            'REMAINING': int(all_fields[3].text)
+        },
+    }
+
+def load_pages():
+    pages = {}
+    for name in sorted(os.listdir(PAGES_DIR)):
+        if name.startswith('compass') and name.endswith('.html'):
+            with open(os.path.join(PAGES_DIR, name)) as file:
+                pages[name] = file.read()
+    return pages
+
+def main():
+    pages = load_pages()
+    failed = False
+
+    for name, html in pages.items():
+        expected = parse_soup(html)
+        actual = parse_compass_seats(html)
+        if expected != actual:
+            failed = True
+            print(f'MISMATCH {name}: expected {expected}, got {actual}')
+
+        soup_time = timeit.timeit(lambda: parse_soup(html), number=ITERATIONS // 10) * 10
+        extractor_time = timeit.timeit(lambda: parse_compass_seats(html), number=ITERATIONS)
+        print(f'{name}: html.parser {soup_time / ITERATIONS * 1e6:.1f} us / extractor {extractor_time / ITERATIONS * 1e6:.1f} us | {soup_time / extractor_time:.0f}x faster')
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
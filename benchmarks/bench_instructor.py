@@ -0,0 +1,80 @@
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import section
+from section import parse_instructor
+
+ITERATIONS = int(os.getenv('BENCH_ITERATIONS', '20000'))
+TERM_SIZE = int(os.getenv('BENCH_TERM_SIZE', '5000'))
+
+# The recursive helper parse_instructor used before, kept as the reference for parity checks
+def recursive_parse_json(json_str):
+    try:
+        parsed = json.loads(json_str)
+
+        if isinstance(parsed, dict):
+            return {k: recursive_parse_json(v) for k, v in parsed.items()}
+        elif isinstance(parsed, list):
+            return [recursive_parse_json(element) for element in parsed]
+        else:
+            return parsed
+    except (json.JSONDecodeError, TypeError):
+        return json_str
+
+def parse_recursive(instructor_result: dict) -> str:
+    if not instructor_result or not instructor_result.get('SWV_CLASS_SEARCH_INSTRCTR_JSON', None):
+        return 'Not assigned'
+
+    unparsed_json = instructor_result['SWV_CLASS_SEARCH_INSTRCTR_JSON']
+    parsed_json = recursive_parse_json(unparsed_json)[0]
+    return parsed_json['NAME'].rstrip('(P)').strip()
+
+def instructor_result(crn, names):
+    # Shaped like a section-meeting-times-with-profs record
+    instructors = [{'NAME': name, 'MORE': str(400000 + i), 'HAS_CV': 'Y' if i % 2 else 'N'} for i, name in enumerate(names)]
+    return {
+        'SWV_CLASS_SEARCH_CRN': crn,
+        'SWV_CLASS_SEARCH_INSTRCTR_JSON': json.dumps(instructors) if instructors else None,
+        'SWV_CLASS_SEARCH_JSON_CLOB': json.dumps([{'SSRMEET_BEGIN_TIME': '0910', 'SSRMEET_END_TIME': '1000', 'SSRMEET_BLDG_CODE': 'ZACH', 'SSRMEET_ROOM_CODE': '350'}])
+    }
+
+PAYLOADS = {
+    'single': instructor_result('10001', ['Jane Doe (P)']),
+    'team taught': instructor_result('10002', ['Jane Doe (P)', 'John Roe', 'Teaching Assistant 1', 'Teaching Assistant 2']),
+    'not assigned': instructor_result('10003', [])
+}
+
+def term_payloads():
+    return [instructor_result(str(10000 + i), [f'Instructor {i} (P)'] + ['Co Instructor'] * (i % 3)) for i in range(TERM_SIZE)]
+
+def backend():
+    return 'orjson' if section.loads is not json.loads else 'json'
+
+def main():
+    failed = False
+    print(f'JSON backend: {backend()}')
+
+    for name, payload in PAYLOADS.items():
+        expected = str(parse_recursive(payload))
+        actual = parse_instructor(payload)
+        if expected != actual:
+            failed = True
+            print(f'MISMATCH {name}: expected {expected!r}, got {actual!r}')
+
+        recursive_time = timeit.timeit(lambda: parse_recursive(payload), number=ITERATIONS)
+        decoder_time = timeit.timeit(lambda: parse_instructor(payload), number=ITERATIONS)
+        print(f'{name}: recursive {recursive_time / ITERATIONS * 1e6:.2f} us / decoder {decoder_time / ITERATIONS * 1e6:.2f} us | {recursive_time / decoder_time:.1f}x faster')
+
+    # A bulk Howdy index decodes one instructor record per section in the term
+    payloads = term_payloads()
+    recursive_time = timeit.timeit(lambda: [parse_recursive(payload) for payload in payloads], number=5) / 5
+    decoder_time = timeit.timeit(lambda: [parse_instructor(payload) for payload in payloads], number=5) / 5
+    print(f'term of {TERM_SIZE}: recursive {recursive_time * 1e3:.1f} ms / decoder {decoder_time * 1e3:.1f} ms | {recursive_time / decoder_time:.1f}x faster')
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,122 @@
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+
+import fake_server
+from bench_tracker import TERM, build_tree
+
+def run_worker(args, shard, shards, ready, start, results):
+    os.environ.update({
+        'CURRENT_TERM': TERM,
+        'HOWDY_API_URL': f'http://127.0.0.1:{args.port}/api',
+        'COMPASS_URL': f'http://127.0.0.1:{args.port}/pls/PROD/bwykschd.p_disp_detail_sched',
+        'MAX_CONCURRENCY': str(args.concurrency),
+        'SHARDING_MODE': 'on',
+        'SHARD_COUNT': str(shards),
+        'WORKER_ID': str(shard)
+    })
+    os.environ.setdefault('PAPERTRAIL_HOST', 'localhost')
+    os.environ.setdefault('PAPERTRAIL_PORT', '514')
+    logging.basicConfig(level=logging.WARNING, force=True)
+
+    # Every worker sees the same tree, as they would all read the same Firebase database
+    import fake_db
+    database = fake_db.install(build_tree(args.sections, args.port, args.watchers, args.seed))
+
+    import main
+    from sharding import ShardedState, ShardMembership
+
+    load_start = time.perf_counter()
+    state = ShardedState(TERM, ShardMembership(shard, shards))
+    state.load()
+    load_time = time.perf_counter() - load_start
+    monitor = main.SectionMonitor(TERM, state)
+
+    async def scan():
+        await monitor.open_session()
+        try:
+            await monitor.check_sections(monitor.crns)
+            await monitor.writer.flush_async()
+        finally:
+            await monitor.close_session()
+
+    ready.wait()
+    start.wait()
+    scan_start = time.perf_counter()
+    asyncio.run(scan())
+    scan_time = time.perf_counter() - scan_start
+
+    results.put((shard, len(monitor.crns), len(state.users), load_time, scan_time, database.calls.get('get', 0)))
+
+def run_shards(args, context, shards):
+    ready = context.Barrier(shards + 1)
+    start = context.Event()
+    results = context.Queue()
+
+    workers = [context.Process(target=run_worker, args=(args, shard, shards, ready, start, results)) for shard in range(shards)]
+    for worker in workers:
+        worker.start()
+
+    # Start every scan together once all shards have loaded their slice
+    ready.wait()
+    wall_start = time.perf_counter()
+    start.set()
+
+    rows = sorted(results.get() for _ in workers)
+    wall_time = time.perf_counter() - wall_start
+    for worker in workers:
+        worker.join()
+
+    for shard, crns, users, load_time, scan_time, gets in rows:
+        print(f'    shard {shard}: {crns} sections / {users} users | load {load_time:.2f}s ({gets} reads) | scan {scan_time:.2f}s')
+
+    total = sum(row[1] for row in rows)
+    return total, wall_time
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Scan throughput of the sharded tracker with 1..N local worker processes')
+    parser.add_argument('--shards', default='1,2,4', help='comma separated worker counts')
+    parser.add_argument('--sections', type=int, default=4000)
+    parser.add_argument('--concurrency', type=int, default=50, help='MAX_CONCURRENCY of each worker')
+    parser.add_argument('--watchers', type=int, default=100)
+    parser.add_argument('--servers', type=int, default=4, help='fake server processes sharing the port')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--change-rate', type=float, default=0.01)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    context = multiprocessing.get_context('spawn')
+
+    servers = [
+        context.Process(target=fake_server.serve, args=(args.port, args.sections, args.latency, 0.0, args.change_rate, args.seed, True), daemon=True)
+        for _ in range(args.servers)
+    ]
+    for server in servers:
+        server.start()
+    time.sleep(1)
+
+    baseline = None
+    try:
+        for shards in [int(shards) for shards in args.shards.split(',')]:
+            print(f'[{shards} shards]')
+            total, wall_time = run_shards(args, context, shards)
+            throughput = total / wall_time
+            baseline = baseline or throughput / shards
+            print(f'    {total} sections in {wall_time:.2f}s | {throughput:.1f} sections / sec | {throughput / baseline:.2f}x single worker')
+    finally:
+        for server in servers:
+            server.terminate()
+
+if __name__ == '__main__':
+    main()
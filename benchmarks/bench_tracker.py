@@ -0,0 +1,147 @@
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+
+import fake_server
+
+TERM = '202531'
+
+def build_tree(size, port, watchers, seed):
+    crns = [fake_server.crn_for(i) for i in range(size)]
+    users = {}
+    for i in range(max(watchers, 1)):
+        users[f'user{i}'] = {
+            'methods': {
+                'discord': {'enabled': True, 'value': f'http://127.0.0.1:{port}/webhooks/user{i}'},
+                'phone': {'enabled': i % 4 == 0, 'value': f'+1979555{i:04d}'},
+                'email': {'enabled': False, 'value': ''}
+            },
+            'settings': {'notificationModes': {'open': True, 'close': True, 'instructors': True}}
+        }
+
+    sections = {}
+    for index, crn in enumerate(crns):
+        sections[crn] = {
+            'seats': fake_server.initial_seats(crn, seed),
+            'instructor': fake_server.instructor_for(crn),
+            'users': {f'user{(index + i) % len(users)}': True for i in range(min(3, len(users)))}
+        }
+
+    return {'sections': {TERM: sections}, 'users': users}
+
+def run_size(args, size):
+    # Point the tracker at the fake server before its modules read the environment
+    os.environ.update({
+        'CURRENT_TERM': TERM,
+        'HOWDY_API_URL': f'http://127.0.0.1:{args.port}/api',
+        'COMPASS_URL': f'http://127.0.0.1:{args.port}/pls/PROD/bwykschd.p_disp_detail_sched',
+        'TWILIO_API_URL': f'http://127.0.0.1:{args.port}',
+        'MAX_CONCURRENCY': str(args.concurrency),
+        'BULK_MODE': 'on' if args.bulk else 'off'
+    })
+    os.environ.setdefault('PAPERTRAIL_HOST', 'localhost')
+    os.environ.setdefault('PAPERTRAIL_PORT', '514')
+    os.environ.setdefault('ACCOUNT_SID', 'ACbenchmark')
+    os.environ.setdefault('AUTH_TOKEN', 'benchmark')
+    os.environ.setdefault('PHONE_NUMBER', '+19795550000')
+    logging.basicConfig(level=logging.WARNING, force=True)
+
+    import fake_db
+    database = fake_db.install(build_tree(size, args.port, args.watchers, args.seed))
+
+    import main
+    import notifications
+    import webhooks
+    from metrics import latency_summary, registry
+    notifications.production = args.production
+    webhooks.production = args.production
+
+    response_cache = main.ResponseCache()
+    host_limits = main.HostLimits()
+    for run in range(args.passes):
+        monitor = main.SectionMonitor(TERM, response_cache=response_cache, host_limits=host_limits)
+        response_cache.reset_stats()
+        host_limits.reset_stats()
+        registry.reset()
+        stages = {}
+
+        async def timed(stage, coroutine):
+            start_time = time.perf_counter()
+            await coroutine
+            stages[stage] = time.perf_counter() - start_time
+
+        async def monitor_sections():
+            await monitor.open_session()
+            try:
+                if args.bulk:
+                    await timed('howdy index', monitor.load_howdy_index())
+                await timed('scan', monitor.check_sections(monitor.crns))
+                await timed('db flush', monitor.writer.flush_async())
+                await timed('notify drain', monitor.dispatcher.drain())
+            finally:
+                await monitor.close_session()
+
+        start_time = time.perf_counter()
+        asyncio.run(monitor_sections())
+        runtime = time.perf_counter() - start_time
+
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        stage_times = ' / '.join(f'{stage} {seconds:.2f}s' for stage, seconds in stages.items())
+        print(f'[{size} sections, pass {run + 1}] {size / runtime:.1f} sections / sec | {runtime:.2f} secs | peak {peak_memory:.0f} MB')
+        print(f'    stages: {stage_times}')
+        print(f'    latency per section: {latency_summary(monitor.latencies)}')
+        print(f'    connections: {monitor.connection_stats}')
+        print(f'    fetch cache: {response_cache}')
+        print(f'    host limits: {monitor.host_limits}')
+        print(f'    notifications: {len(monitor.notifications)} queued | {monitor.dispatcher.summary()}')
+        print(f'    database calls: {database.calls}')
+        print(f'    stage metrics: {registry.stage_summary("tracker_stage_seconds")}')
+        print(f'    request metrics: {registry.stage_summary("tracker_fetch_seconds")}')
+        if args.metrics:
+            registry.dump(f'{args.metrics}.{size}.{run + 1}.json')
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='End-to-end SectionMonitor benchmark against a local fake Howdy/Compass')
+    parser.add_argument('--sizes', default='1000,5000', help='comma separated CRN counts, each run in a fresh process')
+    parser.add_argument('--passes', type=int, default=1)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--watchers', type=int, default=100, help='number of fake users spread over the sections')
+    parser.add_argument('--bulk', action='store_true', help='use the term-wide Howdy index')
+    parser.add_argument('--production', action='store_true', help='actually deliver notifications to the fake webhook and Twilio endpoints')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--change-rate', type=float, default=0.01)
+    parser.add_argument('--capacity', type=int, default=0, help='requests the fake server handles at once before queueing and shedding load')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--metrics', default='', help='write each pass\'s metrics as JSON to PREFIX.<size>.<pass>.json')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    sizes = [int(size) for size in args.sizes.split(',')]
+    context = multiprocessing.get_context('spawn')
+
+    server = context.Process(target=fake_server.serve, args=(args.port, max(sizes), args.latency, args.error_rate, args.change_rate, args.seed, False, args.capacity), daemon=True)
+    server.start()
+    time.sleep(1)
+
+    try:
+        for size in sizes:
+            process = context.Process(target=run_size, args=(args, size))
+            process.start()
+            process.join()
+    finally:
+        server.terminate()
+
+if __name__ == '__main__':
+    main()
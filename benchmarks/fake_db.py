@@ -0,0 +1,85 @@
+import copy
+import threading
+import firebase_admin
+from firebase_admin import db
+
+class InMemoryListener:
+    def close(self):
+        pass
+
+class InMemoryReference:
+    def __init__(self, database, path):
+        self.database = database
+        self.path = '/'.join(part for part in path.split('/') if part)
+
+    def parts(self):
+        return [part for part in self.path.split('/') if part]
+
+    def child(self, path):
+        return InMemoryReference(self.database, f'{self.path}/{path}')
+
+    def get(self, shallow=False):
+        self.database.count('get')
+        with self.database.lock:
+            node = self.database.root
+            for part in self.parts():
+                if not isinstance(node, dict) or part not in node:
+                    return None
+                node = node[part]
+            if shallow and isinstance(node, dict):
+                return {key: True for key in node}
+            return copy.deepcopy(node)
+
+    def set(self, value):
+        self.database.count('set')
+        with self.database.lock:
+            self.database.write(self.parts(), copy.deepcopy(value))
+
+    def delete(self):
+        self.database.count('delete')
+        with self.database.lock:
+            self.database.write(self.parts(), None)
+
+    def update(self, value):
+        self.database.count('update')
+        with self.database.lock:
+            for path, child in value.items():
+                self.database.write(self.parts() + [part for part in path.split('/') if part], copy.deepcopy(child))
+
+    def listen(self, callback):
+        return InMemoryListener()
+
+class InMemoryDatabase:
+    def __init__(self, root=None):
+        self.root = root or {}
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def count(self, method):
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+    def write(self, parts, value):
+        if not parts:
+            self.root = value or {}
+            return
+
+        node = self.root
+        for part in parts[:-1]:
+            if not isinstance(node.get(part), dict):
+                node[part] = {}
+            node = node[part]
+
+        if value is None:
+            node.pop(parts[-1], None)
+        else:
+            node[parts[-1]] = value
+
+    def reference(self, path='/', app=None, url=None):
+        return InMemoryReference(self, path)
+
+def install(root=None) -> InMemoryDatabase:
+    # Stand in for firebase_admin.db so SectionMonitor runs without credentials or network
+    database = InMemoryDatabase(root)
+    firebase_admin._apps.setdefault('[DEFAULT]', None)
+    db.reference = database.reference
+    return database
@@ -0,0 +1,174 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+from aiohttp import web
+
+PAGES_DIR = os.path.join(os.path.dirname(__file__), 'pages')
+SUBJECTS = ['CSCE', 'MATH', 'PHYS', 'CHEM', 'ENGL', 'HIST', 'ECEN', 'MEEN', 'BIOL', 'STAT']
+SEATS_ROW = '<td CLASS="dddefault">96</td>\n<td CLASS="dddefault">91</td>\n<td CLASS="dddefault">5</td>'
+
+def crn_for(index):
+    return str(10000 + index)
+
+def initial_seats(crn, seed=0):
+    return random.Random(f'{seed}:{crn}').randint(0, 40)
+
+def instructor_for(crn):
+    return f'Instructor {crn}'
+
+def section_details(term, crn):
+    index = int(crn) - 10000
+    return {
+        'CRN': crn,
+        'TERM_CODE': term,
+        'SUBJECT_CODE': SUBJECTS[index % len(SUBJECTS)],
+        'COURSE_NUMBER': str(100 + index % 400),
+        'SECTION_NUMBER': str(500 + index % 100),
+        'COURSE_TITLE': f'BENCHMARK COURSE {index}'
+    }
+
+def instructor_record(crn):
+    instructors = [{'NAME': f'{instructor_for(crn)} (P)', 'MORE': '', 'HAS_CV': 'N'}]
+    return {'SWV_CLASS_SEARCH_CRN': crn, 'SWV_CLASS_SEARCH_INSTRCTR_JSON': json.dumps(instructors)}
+
+def json_response(request, payload):
+    # Howdy sits behind a CDN that validates with ETags, so answer conditional requests the same way
+    body = json.dumps(payload)
+    etag = f'"{hashlib.md5(body.encode()).hexdigest()}"'
+    if request.headers.get('If-None-Match') == etag:
+        return web.Response(status=304, headers={'ETag': etag})
+    return web.Response(text=body, content_type='application/json', headers={'ETag': etag})
+
+class FakeTamu:
+    def __init__(self, sections=1000, latency=0.0, error_rate=0.0, change_rate=0.0, seed=0, capacity=0):
+        self.crns = [crn_for(i) for i in range(sections)]
+        self.latency = latency
+        self.capacity = capacity
+        self.queued = 0
+        self.shed = 0
+        self.error_rate = error_rate
+        self.change_rate = change_rate
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.seats = {}
+        self.requests = 0
+        self.messages = 0
+        self.workers = asyncio.Semaphore(capacity) if capacity else None
+
+        with open(os.path.join(PAGES_DIR, 'compass_open.html')) as file:
+            self.page_head, self.page_tail = file.read().split(SEATS_ROW)
+
+    async def delay(self):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency * self.random.uniform(0.5, 1.5))
+
+    @web.middleware
+    async def overload(self, request: web.Request, handler):
+        # Like a real backend, serve capacity requests at a time, queue as many again and shed the rest
+        if not self.workers or request.path == '/stats':
+            return await handler(request)
+        if self.queued >= self.capacity * 2:
+            self.shed += 1
+            return web.Response(status=503)
+
+        self.queued += 1
+        try:
+            async with self.workers:
+                return await handler(request)
+        finally:
+            self.queued -= 1
+
+    def failed(self):
+        return self.random.random() < self.error_rate
+
+    def remaining(self, crn):
+        seats = self.seats.get(crn, initial_seats(crn, self.seed))
+        if self.random.random() < self.change_rate:
+            seats = 0 if seats > 0 else self.random.randint(1, 5)
+        self.seats[crn] = seats
+        return seats
+
+    async def section_details(self, request: web.Request):
+        await self.delay()
+        if self.failed():
+            return web.Response(status=500)
+
+        term, crn, subject = request.query.get('term'), request.query.get('crn'), request.query.get('subject')
+        if crn:
+            return json_response(request, section_details(term, crn))
+
+        details = [section_details(term, crn) for crn in self.crns]
+        return web.json_response([section for section in details if not subject or section['SUBJECT_CODE'] == subject])
+
+    async def section_instructors(self, request: web.Request):
+        await self.delay()
+        if self.failed():
+            return web.Response(status=500)
+
+        body = await request.json()
+        if body.get('crn'):
+            return json_response(request, instructor_record(body['crn']))
+
+        return web.json_response([instructor_record(crn) for crn in self.crns])
+
+    async def compass_page(self, request: web.Request):
+        await self.delay()
+        if self.failed():
+            return web.Response(status=500)
+
+        remaining = self.remaining(request.query['crn_in'])
+        seats = f'<td CLASS="dddefault">40</td>\n<td CLASS="dddefault">{40 - remaining}</td>\n<td CLASS="dddefault">{remaining}</td>'
+        return web.Response(text=self.page_head + seats + self.page_tail, content_type='text/html')
+
+    async def discord_webhook(self, request: web.Request):
+        await self.delay()
+        await request.read()
+        self.messages += 1
+        return web.Response(status=204, headers={'X-RateLimit-Remaining': '4', 'X-RateLimit-Reset-After': '0.5'})
+
+    async def twilio_message(self, request: web.Request):
+        await self.delay()
+        if self.failed():
+            return web.json_response({'code': 20429, 'message': 'Too Many Requests'}, status=429, headers={'Retry-After': '0.1'})
+
+        form = await request.post()
+        self.messages += 1
+        return web.json_response({'sid': f'SM{self.messages:032d}', 'to': form.get('To'), 'status': 'queued'}, status=201)
+
+    async def stats(self, request: web.Request):
+        return web.json_response({'requests': self.requests, 'messages': self.messages, 'shed': self.shed})
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self.overload])
+        app.router.add_get('/api/course-section-details', self.section_details)
+        app.router.add_post('/api/section-meeting-times-with-profs', self.section_instructors)
+        app.router.add_get('/pls/PROD/bwykschd.p_disp_detail_sched', self.compass_page)
+        app.router.add_post('/webhooks/{id}', self.discord_webhook)
+        app.router.add_post('/2010-04-01/Accounts/{sid}/Messages.json', self.twilio_message)
+        app.router.add_get('/stats', self.stats)
+        return app
+
+def serve(port, sections=1000, latency=0.0, error_rate=0.0, change_rate=0.0, seed=0, reuse_port=False, capacity=0):
+    # reuse_port lets several server processes share the port when one would be the bottleneck
+    fake = FakeTamu(sections, latency, error_rate, change_rate, seed, capacity)
+    web.run_app(fake.app(), host='127.0.0.1', port=port, access_log=None, print=None, reuse_port=reuse_port)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Local stand-in for the Howdy and Compass endpoints')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--sections', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.0, help='mean response delay in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with 500')
+    parser.add_argument('--change-rate', type=float, default=0.0, help='chance a section opens or closes on each Compass fetch')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--capacity', type=int, default=0, help='requests served at once before queueing and then shedding with 503, 0 for unlimited')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    print(f'Serving {args.sections} fake sections on http://127.0.0.1:{args.port}')
+    serve(args.port, args.sections, args.latency, args.error_rate, args.change_rate, args.seed, capacity=args.capacity)
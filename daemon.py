@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import os
+import time
+import requests
+from dotenv import load_dotenv
+from embed import error_embed
+from logging_config import init_logging
+from main import SectionMonitor, init_firebase, CURRENT_TERM, MAX_CONCURRENCY, CONSOLE_URL
+from metrics import latency_summary, registry, start_metrics_server
+from scheduler import PollScheduler
+from section import bulk
+from state import StateCache
+from sharding import create_state, sharded
+
+load_dotenv(override=True)
+FLUSH_INTERVAL = float(os.getenv('FLUSH_INTERVAL', '1'))
+SUMMARY_INTERVAL = float(os.getenv('SUMMARY_INTERVAL', '60'))
+BULK_REFRESH_INTERVAL = float(os.getenv('BULK_REFRESH_INTERVAL', '300'))
+
+class TrackerDaemon:
+    def __init__(self, state: StateCache):
+        self.state = state
+        self.monitor = SectionMonitor(CURRENT_TERM, state)
+        self.scheduler = PollScheduler()
+        self.checked = 0
+        self.errors = 0
+
+    async def worker(self):
+        while True:
+            crn = self.scheduler.next_crn()
+            if crn is None:
+                await asyncio.sleep(min(self.scheduler.time_until_next(), FLUSH_INTERVAL))
+                continue
+
+            start_time = time.perf_counter()
+            changed = False
+            try:
+                changed = await self.monitor.check_change(crn)
+            except Exception as e:
+                self.errors += 1
+                self.monitor.response_cache.forget(crn)
+                logging.exception(f'Exception raised while checking section {crn}: {e}')
+            finally:
+                self.monitor.latencies.append(time.perf_counter() - start_time)
+                registry.observe('tracker_stage_seconds', self.monitor.latencies[-1], stage='check')
+                self.checked += 1
+                self.scheduler.reschedule(crn, self.monitor.sections.get(crn), changed)
+
+    async def housekeeping(self):
+        last_summary = last_bulk = time.monotonic()
+
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            self.scheduler.sync(self.state.crns())
+            self.monitor.clear_notifications()
+            self.monitor.forget_dropped()
+
+            try:
+                await self.monitor.writer.flush_async()
+                if sharded:
+                    # Only the database reads leave the loop, the slice is swapped in here between checks
+                    fetched = await asyncio.to_thread(self.state.fetch_if_due)
+                    if fetched:
+                        self.state.apply(*fetched)
+                if self.state.snapshot_due():
+                    # Serialized on the loop, as checks update the tracked sections here without the state lock
+                    snapshot = self.state.dump()
+                    await asyncio.to_thread(self.state.write_snapshot, snapshot)
+
+                if bulk and time.monotonic() - last_bulk >= BULK_REFRESH_INTERVAL:
+                    await self.monitor.load_howdy_index()
+                    last_bulk = time.monotonic()
+            except Exception as e:
+                logging.exception(f'Exception raised during daemon housekeeping: {e}')
+
+            if time.monotonic() - last_summary >= SUMMARY_INTERVAL:
+                self.log_summary(time.monotonic() - last_summary)
+                last_summary = time.monotonic()
+
+    def log_summary(self, elapsed):
+        logging.info(f'DAEMON: {self.checked} sections checked in {elapsed:.0f} secs | {self.checked / elapsed:.2f} sections / sec | {self.errors} errors | {len(self.scheduler.due)} scheduled')
+        logging.info(f'Latency per section: {latency_summary(self.monitor.latencies)}')
+        logging.info(f'Notifications: {self.monitor.dispatcher.summary()}')
+        logging.info(f'Connections: {self.monitor.connection_stats}')
+        logging.info(f'Fetch cache: {self.monitor.response_cache}')
+        logging.info(f'Host limits: {self.monitor.host_limits}')
+        logging.info(f'Stages: {registry.stage_summary("tracker_stage_seconds")}')
+        logging.info(f'Requests: {registry.stage_summary("tracker_fetch_seconds")}')
+        registry.dump()
+
+        self.checked = 0
+        self.errors = 0
+        self.monitor.latencies = []
+        self.monitor.dispatcher.reset_stats()
+        self.monitor.response_cache.reset_stats()
+        self.monitor.host_limits.reset_stats()
+
+    async def run(self):
+        self.scheduler.sync(self.state.crns())
+        await self.monitor.open_session()
+        metrics_server = await start_metrics_server()
+
+        try:
+            if bulk:
+                await self.monitor.load_howdy_index()
+            await asyncio.gather(self.housekeeping(), *[self.worker() for _ in range(MAX_CONCURRENCY)])
+        finally:
+            await self.monitor.writer.flush_async()
+            await self.monitor.close_session()
+            if metrics_server:
+                await metrics_server.cleanup()
+
+def main():
+    init_logging()
+    init_firebase()
+
+    state = create_state(CURRENT_TERM)
+    state.load()
+    state.listen()
+    logging.info(f'Starting tracker daemon / {len(state.crns())} sections')
+
+    try:
+        asyncio.run(TrackerDaemon(state).run())
+    except Exception as e:
+        logging.exception(f'Exception raised in tracker daemon: {e}')
+        requests.post(CONSOLE_URL, json=error_embed(e))
+    finally:
+        state.close()
+        state.save()
+
+if __name__ == '__main__':
+    main()
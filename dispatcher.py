@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import os
+import time
+import aiohttp
+from dotenv import load_dotenv
+from notifications import Notification, NotiType, coalesce
+from webhooks import WebhookQueue
+from metrics import latency_summary
+
+load_dotenv(override=True)
+
+# Maximum in-flight sends per notification channel
+TEXT_CONCURRENCY = int(os.getenv('TEXT_CONCURRENCY', '8'))
+DISCORD_CONCURRENCY = int(os.getenv('DISCORD_CONCURRENCY', '20'))
+EMAIL_CONCURRENCY = int(os.getenv('EMAIL_CONCURRENCY', '8'))
+
+# Seconds a destination must go quiet before its held notifications are sent as one message. Each new
+# notification restarts the window, up to COALESCE_MAX_HOLD secs after the first, so every alert in a burst
+# is delayed by up to the max hold in exchange for fewer messages. Texts are billed per message and a pass
+# spreads one user's changes over a few secs, so they wait longer. Discord queues already fold concurrent
+# posts and emails only group recipients of the same event, so those stay short
+TEXT_COALESCE_WINDOW = float(os.getenv('TEXT_COALESCE_WINDOW', '2'))
+COALESCE_WINDOW = float(os.getenv('COALESCE_WINDOW', '0.25'))
+COALESCE_MAX_HOLD = float(os.getenv('COALESCE_MAX_HOLD', '10'))
+
+class NotificationDispatcher:
+    def __init__(self, limits: dict = None, windows: dict = None, max_hold=COALESCE_MAX_HOLD):
+        self.limits = limits or {
+            NotiType.TEXT: TEXT_CONCURRENCY,
+            NotiType.DISCORD: DISCORD_CONCURRENCY,
+            NotiType.EMAIL: EMAIL_CONCURRENCY
+        }
+        self.windows = windows or {
+            NotiType.TEXT: TEXT_COALESCE_WINDOW,
+            NotiType.DISCORD: COALESCE_WINDOW,
+            NotiType.EMAIL: COALESCE_WINDOW
+        }
+        self.max_hold = max_hold
+        self.semaphores = {}
+        self.session = None
+        self.tasks = set()
+        self.webhooks = {}
+        self.pending = {}
+        self.timers = {}
+        self.deadlines = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.sent = {noti_type: 0 for noti_type in NotiType}
+        self.failed = {noti_type: 0 for noti_type in NotiType}
+        self.send_latencies = {noti_type: [] for noti_type in NotiType}
+        self.delivery_latencies = []
+        self.received = 0
+        self.messages = 0
+        for webhook in self.webhooks.values():
+            webhook.posts = 0
+            webhook.retries = 0
+
+    async def start(self):
+        connector = aiohttp.TCPConnector(limit=sum(self.limits.values()), keepalive_timeout=30)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=30))
+        self.semaphores = {noti_type: asyncio.Semaphore(limit) for noti_type, limit in self.limits.items()}
+
+    def submit(self, notification: Notification):
+        window = self.windows.get(notification.type, 0)
+        if window <= 0:
+            self.received += 1
+            self.messages += 1
+            self.schedule(notification)
+            return
+
+        loop = asyncio.get_running_loop()
+        key = notification.coalesce_key()
+        if key not in self.pending:
+            self.pending[key] = []
+            self.deadlines[key] = loop.time() + self.max_hold
+        else:
+            self.timers[key].cancel()
+        self.pending[key].append(notification)
+
+        delay = min(window, self.deadlines[key] - loop.time())
+        self.timers[key] = loop.call_later(max(delay, 0), self.flush, key)
+
+    def flush(self, key):
+        notifications = self.pending.pop(key, [])
+        self.deadlines.pop(key, None)
+        timer = self.timers.pop(key, None)
+        if timer:
+            timer.cancel()
+
+        messages = coalesce(notifications)
+        self.received += len(notifications)
+        self.messages += len(messages)
+        for message in messages:
+            self.schedule(message)
+
+    def flush_all(self):
+        for key in list(self.pending):
+            self.flush(key)
+
+    def schedule(self, notification: Notification):
+        task = asyncio.create_task(self.deliver(notification))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def webhook(self, url) -> WebhookQueue:
+        if url not in self.webhooks:
+            self.webhooks[url] = WebhookQueue(url, self.session, self.semaphores[NotiType.DISCORD])
+        return self.webhooks[url]
+
+    async def deliver(self, notification: Notification):
+        start_time = time.perf_counter()
+        try:
+            # Discord messages go through a per-webhook queue which applies the channel limit itself
+            if notification.type == NotiType.DISCORD:
+                await notification.send(self.session, self.webhook(notification.destination))
+            else:
+                async with self.semaphores[notification.type]:
+                    start_time = time.perf_counter()
+                    await notification.send(self.session)
+            self.sent[notification.type] += 1
+        except Exception as e:
+            self.failed[notification.type] += 1
+            logging.exception(f'Could not send {notification.type.name} notification to {notification.destination}: {e}')
+        finally:
+            end_time = time.perf_counter()
+            self.send_latencies[notification.type].append(end_time - start_time)
+            self.delivery_latencies.append(end_time - notification.created)
+
+    async def drain(self):
+        self.flush_all()
+        while self.tasks:
+            await asyncio.gather(*list(self.tasks))
+
+    async def close(self):
+        await self.drain()
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    def summary(self):
+        channels = ', '.join(
+            f'{noti_type.name} {self.sent[noti_type]} sent / {self.failed[noti_type]} failed ({latency_summary(self.send_latencies[noti_type])})'
+            for noti_type in NotiType if self.sent[noti_type] or self.failed[noti_type]
+        )
+        webhook_posts = sum(webhook.posts for webhook in self.webhooks.values())
+        webhook_retries = sum(webhook.retries for webhook in self.webhooks.values())
+        return f'{channels or "none sent"} | {self.received} notifications coalesced into {self.messages} messages ({self.received - self.messages} sends saved) | {webhook_posts} webhook posts / {webhook_retries} retries | detection to delivery {latency_summary(self.delivery_latencies)}'
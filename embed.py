@@ -1,4 +1,4 @@
-from typing import Dict
+from section import Section
 
 # Default icons for discord embed
 TAMU_LOGO = 'https://i.imgur.com/qHXokad.jpeg'
@@ -25,12 +25,12 @@ def generate_link(term_code):
         term_string = f'{semester} {year} - {location}'
     return f'https://tamu.collegescheduler.com/terms/{term_string}/options'
 
-def format_title(section: Dict, title: str) -> str:
-    title = title.replace('%t', section['COURSE_TITLE'])
-    title = title.replace('%c', str(section['CRN']))
-    title = title.replace('%C', section['SUBJECT_CODE'] + " " + section['COURSE_NUMBER'])
-    title = title.replace('%S', str(section['SECTION_NUMBER']))
-    title = title.replace('%p', section['INSTRUCTOR'])
+def format_title(section: Section, title: str) -> str:
+    title = title.replace('%t', section.title)
+    title = title.replace('%c', section.crn)
+    title = title.replace('%C', section.course)
+    title = title.replace('%S', section.section_number)
+    title = title.replace('%p', section.instructor)
 
     return title
 
@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from dotenv import load_dotenv
+from metrics import registry
+
+load_dotenv(override=True)
+
+# AIMD bounds and step sizes for each upstream host
+ADAPTIVE_LIMITS = os.getenv('ADAPTIVE_LIMITS', 'on')
+ADAPTIVE_MIN_CONCURRENCY = int(os.getenv('ADAPTIVE_MIN_CONCURRENCY', '1'))
+ADAPTIVE_MAX_CONCURRENCY = int(os.getenv('ADAPTIVE_MAX_CONCURRENCY', '100'))
+ADAPTIVE_INCREASE = float(os.getenv('ADAPTIVE_INCREASE', '1'))
+ADAPTIVE_BACKOFF = float(os.getenv('ADAPTIVE_BACKOFF', '0.7'))
+# Latency counts as congestion once the smoothed latency exceeds this multiple of the best seen
+ADAPTIVE_LATENCY_TOLERANCE = float(os.getenv('ADAPTIVE_LATENCY_TOLERANCE', '2.5'))
+# and by at least this many secs, so scheduling jitter on a fast host isn't read as queueing
+ADAPTIVE_LATENCY_SLACK = float(os.getenv('ADAPTIVE_LATENCY_SLACK', '0.05'))
+
+# The breaker opens when this share of the last BREAKER_WINDOW requests failed
+BREAKER_WINDOW = int(os.getenv('BREAKER_WINDOW', '20'))
+BREAKER_THRESHOLD = float(os.getenv('BREAKER_THRESHOLD', '0.5'))
+BREAKER_COOLDOWN = float(os.getenv('BREAKER_COOLDOWN', '5'))
+BREAKER_MAX_COOLDOWN = float(os.getenv('BREAKER_MAX_COOLDOWN', '120'))
+adaptive = ADAPTIVE_LIMITS == 'on'
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+CIRCUIT_STATES = (CLOSED, HALF_OPEN, OPEN)
+
+class CircuitOpenError(Exception):
+    pass
+
+def failed_status(status) -> bool:
+    return status == 429 or status >= 500
+
+class AdaptiveLimiter:
+    def __init__(self, host, limit, min_limit=ADAPTIVE_MIN_CONCURRENCY, max_limit=ADAPTIVE_MAX_CONCURRENCY):
+        self.host = host
+        self.min_limit = min_limit
+        self.max_limit = max(max_limit, limit) if adaptive else limit
+        self.limit = float(limit)
+        self.in_flight = 0
+        self.waiters = deque()
+
+        # Best latency seen, drifting up slowly so a lasting shift becomes the new normal
+        self.baseline = None
+        self.smoothed = None
+        self.last_decrease = 0.0
+
+        self.state = CLOSED
+        self.outcomes = deque(maxlen=BREAKER_WINDOW)
+        self.opened_at = 0.0
+        self.cooldown = BREAKER_COOLDOWN
+
+        self.successes = 0
+        self.failures = 0
+        self.rejected = 0
+        self.trips = 0
+        self.peak_limit = self.limit
+
+    def capacity(self) -> int:
+        # A half-open breaker lets a single probe through
+        return 1 if self.state == HALF_OPEN else int(self.limit)
+
+    def check_circuit(self):
+        if self.state != OPEN:
+            return
+        if time.monotonic() - self.opened_at < self.cooldown:
+            self.rejected += 1
+            raise CircuitOpenError(f'Circuit for {self.host} is open')
+
+        self.set_state(HALF_OPEN)
+        logging.info(f'Circuit for {self.host} is half-open, probing')
+
+    async def acquire(self):
+        self.check_circuit()
+        if self.in_flight < self.capacity() and not self.waiters:
+            self.in_flight += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append(future)
+        try:
+            # wake() hands the slot over by counting it before resolving the future
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.in_flight -= 1
+                self.wake()
+            elif future in self.waiters:
+                self.waiters.remove(future)
+            raise
+
+    def wake(self):
+        while self.waiters and self.in_flight < self.capacity():
+            future = self.waiters.popleft()
+            if not future.done():
+                self.in_flight += 1
+                future.set_result(None)
+
+    def release(self, latency, ok):
+        # ok is None when the caller gave up, which says nothing about the host
+        self.in_flight -= 1
+        registry.set('tracker_host_limit', int(self.limit), host=self.host)
+        if ok is not None:
+            # latency is None for requests too unlike the rest to say anything about congestion
+            if latency is not None:
+                self.smoothed = latency if self.smoothed is None else self.smoothed * 0.9 + latency * 0.1
+            self.outcomes.append(ok)
+            if ok:
+                self.on_success(latency)
+            else:
+                self.on_failure()
+        self.wake()
+
+    def on_success(self, latency):
+        self.successes += 1
+        if self.state == HALF_OPEN:
+            self.close()
+        if latency is None:
+            return
+
+        self.baseline = latency if self.baseline is None or latency < self.baseline else self.baseline + (latency - self.baseline) * 0.01
+
+        if self.smoothed > max(self.baseline * ADAPTIVE_LATENCY_TOLERANCE, self.baseline + ADAPTIVE_LATENCY_SLACK):
+            self.decrease()
+        elif adaptive:
+            # Additive increase of roughly ADAPTIVE_INCREASE per limit's worth of successful requests
+            self.limit = min(self.max_limit, self.limit + ADAPTIVE_INCREASE / self.limit)
+            self.peak_limit = max(self.peak_limit, self.limit)
+
+    def on_failure(self):
+        self.failures += 1
+        if self.state == HALF_OPEN:
+            self.trip(self.cooldown * 2)
+            return
+
+        self.decrease()
+        # Requests sent before the breaker opened still report in, which shouldn't extend the cooldown
+        if self.state == CLOSED and len(self.outcomes) >= BREAKER_WINDOW and self.outcomes.count(False) >= BREAKER_THRESHOLD * len(self.outcomes):
+            self.trip(BREAKER_COOLDOWN)
+
+    def decrease(self):
+        # Requests already in flight when the host slowed down report together, so back off once per round trip
+        now = time.monotonic()
+        if not adaptive or now - self.last_decrease < (self.smoothed or 0):
+            return
+        self.last_decrease = now
+        self.limit = max(self.min_limit, self.limit * ADAPTIVE_BACKOFF)
+
+    def set_state(self, state):
+        self.state = state
+        registry.set('tracker_host_circuit_state', CIRCUIT_STATES.index(state), host=self.host)
+
+    def trip(self, cooldown):
+        self.set_state(OPEN)
+        self.opened_at = time.monotonic()
+        self.cooldown = min(cooldown, BREAKER_MAX_COOLDOWN)
+        self.trips += 1
+        self.limit = max(self.min_limit, self.limit * ADAPTIVE_BACKOFF) if adaptive else self.limit
+        logging.warning(f'Circuit for {self.host} opened for {self.cooldown:g} secs after {self.outcomes.count(False)} failures in the last {len(self.outcomes)} requests')
+
+        # Anything queued would only pile onto a failing host
+        while self.waiters:
+            future = self.waiters.popleft()
+            if not future.done():
+                self.rejected += 1
+                future.set_exception(CircuitOpenError(f'Circuit for {self.host} is open'))
+
+    def close(self):
+        self.set_state(CLOSED)
+        self.outcomes.clear()
+        self.cooldown = BREAKER_COOLDOWN
+        logging.info(f'Circuit for {self.host} closed')
+
+    def reset_stats(self):
+        self.successes = 0
+        self.failures = 0
+        self.rejected = 0
+        self.trips = 0
+        self.peak_limit = self.limit
+
+    def __str__(self):
+        latency = f'{self.smoothed * 1000:.0f} ms (best {self.baseline * 1000:.0f} ms)' if self.baseline is not None else 'no samples'
+        return (f'{self.host} {self.state}, limit {int(self.limit)} (peak {int(self.peak_limit)}), {latency} | '
+                f'{self.successes} ok / {self.failures} failed / {self.rejected} rejected | {self.trips} trips')
+
+class Permit:
+    def __init__(self, limiter: AdaptiveLimiter, sample=True):
+        self.limiter = limiter
+        self.sample = sample
+        self.status = None
+        self.start_time = 0.0
+
+    async def __aenter__(self):
+        await self.limiter.acquire()
+        self.start_time = time.perf_counter()
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        if exc_type is asyncio.CancelledError:
+            ok = None
+        else:
+            ok = exc_type is None and not (self.status is not None and failed_status(self.status))
+        self.limiter.release(time.perf_counter() - self.start_time if self.sample else None, ok)
@@ -1,6 +1,10 @@
+import atexit
 import logging
+import queue
 import socket
-from logging.handlers import SysLogHandler
+import threading
+import time
+from logging.handlers import SysLogHandler, QueueHandler, QueueListener
 from dotenv import load_dotenv
 import os
 
@@ -8,12 +12,62 @@ load_dotenv()
 PAPERTRAIL_HOST = os.getenv('PAPERTRAIL_HOST')
 PAPERTRAIL_PORT = int(os.getenv('PAPERTRAIL_PORT'))
 
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# Per-CRN lines go through their own logger so they can be leveled and rate limited separately
+SECTION_LOGGER = 'tracker.sections'
+# Change detection and sends log here: a child logger inherits the level but never the rate limit
+AUDIT_LOGGER = 'tracker.sections.audit'
+SECTION_LOG_LEVEL = os.getenv('SECTION_LOG_LEVEL', LOG_LEVEL).upper()
+LIBRARY_LOG_LEVEL = os.getenv('LIBRARY_LOG_LEVEL', 'WARNING').upper()
+LIBRARY_LOGGERS = ('urllib3', 'google', 'firebase_admin', 'aiohttp', 'asyncio')
+
+# At most LOG_RATE_LIMIT per-CRN lines with the same message every LOG_RATE_INTERVAL secs, 0 to disable.
+# Only lines below LOG_RATE_LEVEL are limited, so by default warnings and info lines always get through
+LOG_RATE_LIMIT = int(os.getenv('LOG_RATE_LIMIT', '20'))
+LOG_RATE_INTERVAL = float(os.getenv('LOG_RATE_INTERVAL', '10'))
+LOG_RATE_LEVEL = logging.getLevelName(os.getenv('LOG_RATE_LEVEL', 'INFO').upper())
+
 class ContextFilter(logging.Filter):
     hostname = socket.gethostname()
     def filter(self, record):
         record.hostname = ContextFilter.hostname
         return True
 
+class RateLimitFilter(logging.Filter):
+    def __init__(self, limit=LOG_RATE_LIMIT, interval=LOG_RATE_INTERVAL, level=LOG_RATE_LEVEL):
+        super().__init__()
+        self.limit = limit
+        self.interval = interval
+        self.level = level
+        # (level, message template) -> [window start, records let through, records dropped]
+        self.windows = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if self.limit <= 0 or record.levelno >= self.level:
+            return True
+
+        now = time.monotonic()
+        key = (record.levelno, record.msg)
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                dropped = window[2] if window else 0
+                window = self.windows[key] = [now, 0, 0]
+                if dropped:
+                    record.msg = f'{record.msg} ({dropped} similar messages suppressed)'
+
+            if window[1] >= self.limit:
+                window[2] += 1
+                return False
+            window[1] += 1
+            return True
+
+class LazyQueueHandler(QueueHandler):
+    def prepare(self, record):
+        # The queue never leaves the process, so leave formatting to the listener thread
+        return record
+
 def init_logging():
     syslog = SysLogHandler(address=(PAPERTRAIL_HOST, PAPERTRAIL_PORT))
     syslog.addFilter(ContextFilter())
@@ -22,6 +76,19 @@ def init_logging():
     formatter = logging.Formatter(format, datefmt='%b %d %H:%M:%S')
     syslog.setFormatter(formatter)
 
+    # Records are handed to a background thread, so socket writes never block the event loop
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, syslog, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
     logger = logging.getLogger()
-    logger.addHandler(syslog)
-    logger.setLevel(logging.DEBUG)
+    logger.addHandler(LazyQueueHandler(log_queue))
+    logger.setLevel(LOG_LEVEL)
+
+    section_logger = logging.getLogger(SECTION_LOGGER)
+    section_logger.setLevel(SECTION_LOG_LEVEL)
+    section_logger.addFilter(RateLimitFilter())
+
+    for name in LIBRARY_LOGGERS:
+        logging.getLogger(name).setLevel(LIBRARY_LOG_LEVEL)
@@ -2,179 +2,270 @@ import time
 import firebase_admin
 from firebase_admin import credentials, db
 import logging
-from notifications import SeatNotification, InstructorNotification, NotiType, generate_seat_web, generate_instructor_web
+from notifications import SeatNotification, InstructorNotification, generate_seat_web, generate_instructor_web
+from subscribers import SubscriberIndex, seats_event, INSTRUCTOR
 from logging_config import init_logging
-from section import get_section_info
+from section import get_section_info, create_session, build_howdy_index, ConnectionStats, HostLimits, ResponseCache, Section, UNCHANGED, bulk, BULK_SUBJECTS
 import os
 import asyncio
 from embed import error_embed
+from writer import DatabaseWriter
+from dispatcher import NotificationDispatcher
+from metrics import latency_summary, registry
+from state import StateCache
+from sharding import create_state, sharded, SHARD_COUNT
 import requests
 from dotenv import load_dotenv
 
 load_dotenv(override=True)
 CURRENT_TERM = os.getenv('CURRENT_TERM')
-BATCH_SIZE = int(os.getenv('BATCH_SIZE'), 10)
+MAX_CONCURRENCY = int(os.getenv('MAX_CONCURRENCY', os.getenv('BATCH_SIZE', '50')), 10)
 CERTIFICATE_PATH = os.getenv('CERTIFICATE_PATH')
 DATABASE_URL = os.getenv('DATABASE_URL')
 CONSOLE_URL = os.getenv('CONSOLE_URL')
 
-def split_list(arr, batch_size):
-    return [arr[i:i + batch_size] for i in range(0, len(arr), batch_size)]
+# Long-running mode keeps sections and users in memory between passes instead of exiting after one
+LONG_RUNNING_MODE = os.getenv('LONG_RUNNING_MODE', 'off')
+PASS_INTERVAL = float(os.getenv('PASS_INTERVAL', '8'))
+long_running = LONG_RUNNING_MODE == 'on'
+
+section_log = logging.getLogger('tracker.sections')
+audit_log = logging.getLogger('tracker.sections.audit')
+
+def init_firebase():
+    if not firebase_admin._apps:
+        cred = credentials.Certificate(CERTIFICATE_PATH)
+        firebase_admin.initialize_app(cred, {
+            'databaseURL': DATABASE_URL
+        })
 
 class SectionMonitor:
-    def __init__(self, term):
-        if not firebase_admin._apps:
-            cred = credentials.Certificate(CERTIFICATE_PATH)
-            firebase_admin.initialize_app(cred, {
-                'databaseURL': DATABASE_URL
-            })
+    def __init__(self, term, state: StateCache = None, response_cache: ResponseCache = None, host_limits: HostLimits = None, writer: DatabaseWriter = None):
+        init_firebase()
 
         self.term = term
-        self.sections = db.reference(f'sections/{self.term}/').get()
-        self.users = db.reference('users/').get()
+        self.state = state
+        if state:
+            self.sections = state.sections
+            self.users = state.users
+            self.crns = state.crns()
+            self.subscribers = state.subscribers
+        else:
+            self.sections = db.reference(f'sections/{self.term}/').get() or {}
+            self.users = db.reference('users/').get() or {}
+            self.crns = list(self.sections.keys())
+            self.subscribers = SubscriberIndex(self.sections, self.users)
 
         self.seen = set()
         self.notifications = []
+        self.writer = writer or DatabaseWriter()
+        self.dispatcher = NotificationDispatcher()
 
-    async def check_change(self, crn):
-        section = await get_section_info(self.term, crn)
-        if not section:
-            logging.warn(f'Section {crn} is invalid, skipping over')
-            return
-        
-        logging.debug(f'Fetched section {crn}, {section["SUBJECT_CODE"]} {section["COURSE_NUMBER"]} - {section["COURSE_TITLE"]}')
-        
-        crn = section['CRN']
-
-        if self.sections[crn].get('users', None) is None:
-            logging.info(f'Section {crn} has no active users, removing from database')
-            db.reference(f'sections/{self.term}/{crn}').delete()
-            return
-        
-        prev_seats = self.sections[crn].get('seats', None)
-        curr_seats = section['SEATS']['REMAINING']
-        prev_instructor = self.sections[crn].get('instructor', None)
-        curr_instructor = section['INSTRUCTOR']
+        self.connection_stats = ConnectionStats()
+        self.session = None
+        self.howdy_index = {}
+        self.response_cache = response_cache or ResponseCache()
+        self.host_limits = host_limits
+        self.latencies = []
 
-        if prev_seats != curr_seats:
-            seats_ref = db.reference(f'sections/{self.term}/{crn}/seats')
-            seats_ref.set(curr_seats)
-            if prev_seats is not None:
-                self.create_seats_noti(section, prev_seats, curr_seats)
+    async def open_session(self):
+        self.session = create_session(self.connection_stats)
+        if self.host_limits is None:
+            self.host_limits = HostLimits()
+        await self.dispatcher.start()
 
-        if prev_instructor != curr_instructor:
-            instructor_ref = db.reference(f'sections/{self.term}/{crn}/instructor')
-            instructor_ref.set(curr_instructor)
-            if prev_instructor is not None:
-                self.create_instructor_noti(section, prev_instructor, curr_instructor)
+    async def close_session(self):
+        await self.dispatcher.close()
+        if self.session:
+            await self.session.close()
+            self.session = None
 
-    def create_seats_noti(self, section, previous, current):
-        logging.info(f'Detected seats change in section {section['CRN']}, from {previous} to {current}')
-        tracking_users = self.sections[section['CRN']].get('users', {})
+    async def load_howdy_index(self):
+        start_time = time.time()
+        with registry.timer('tracker_stage_seconds', stage='howdy_index'):
+            self.howdy_index = await build_howdy_index(self.session, self.term, BULK_SUBJECTS, self.host_limits)
+        logging.info(f'Loaded {len(self.howdy_index)} sections from Howdy in bulk in {time.time() - start_time:.2f} secs')
 
-        for uid in tracking_users:
-            user = self.users[uid]
-            if 'methods' not in user:
-                logging.warning(f'User {uid} does not have methods field, skipping')
-                continue
+    async def check_sections(self, crns, concurrency=MAX_CONCURRENCY):
+        queue = asyncio.Queue()
+        for crn in crns:
+            queue.put_nowait(crn)
 
-            if 'settings' not in user:
-                logging.warning(f'User {uid} does not have settings field, skipping')
-                continue
+        async def worker():
+            while not queue.empty():
+                crn = queue.get_nowait()
+                start_time = time.perf_counter()
+                try:
+                    await self.check_change(crn)
+                finally:
+                    self.latencies.append(time.perf_counter() - start_time)
+                    registry.observe('tracker_stage_seconds', self.latencies[-1], stage='check')
 
-            conditions = user['settings']['notificationModes']
+        await asyncio.gather(*[worker() for _ in range(min(concurrency, len(crns)))])
 
-            if (conditions['open'] and previous <= 0 < current) or (conditions['close'] and current <= 0 < previous):
-                methods = user['methods']
-                generate_seat_web(uid, section, previous, current)
+    async def check_change(self, crn):
+        with registry.timer('tracker_stage_seconds', stage='fetch'):
+            section = await get_section_info(self.session, self.term, crn, self.howdy_index, self.host_limits, self.response_cache)
+        if not section:
+            section_log.warning('Section %s is invalid, skipping over', crn)
+            return
 
-                if methods['discord']['enabled']:
-                    webhook_url = methods['discord']['value']
-                    notification = SeatNotification(section, previous, current, NotiType.DISCORD, webhook_url)
-                    self.add_notification(notification)
+        tracked = self.sections.get(crn)
+        if tracked is None:
+            return
 
-                if methods['phone']['enabled']:
-                    phone_number = methods['phone']['value']
-                    notification = SeatNotification(section, previous, current, NotiType.TEXT, phone_number)
-                    self.add_notification(notification)
+        if tracked.get('users', None) is None:
+            audit_log.info('Section %s has no active users, removing from database', crn)
+            self.writer.delete(f'sections/{self.term}/{crn}')
+            self.sections.pop(crn, None)
+            self.subscribers.update_section(crn)
+            self.response_cache.forget(crn)
+            registry.inc('tracker_changes_total', kind='removed')
+            return
 
-                if methods['email']['enabled']:
-                    email_address = methods['email']['value']
-                    notification = SeatNotification(section, previous, current, NotiType.EMAIL, email_address)
-                    self.add_notification(notification)
+        if section is UNCHANGED:
+            # The site can recreate a section without our fields, so only skip when they match what we fetched
+            section = self.response_cache.results[crn]
+            if tracked.get('seats') == section.seats and tracked.get('instructor') == section.instructor:
+                return False
 
-    def create_instructor_noti(self, section, previous, current):
-        logging.info(f'Detected instructor change in section {section['CRN']}, from {previous} to {current}')
-        tracking_users = self.sections[section['CRN']].get('users', {})
+        section_log.debug('Fetched section %s, %s - %s', crn, section.course, section.title)
 
-        for uid in tracking_users:
-            user = self.users[uid]
-            if 'methods' not in user:
-                logging.warning(f'User {uid} does not have methods field, skipping')
-                continue
+        prev_seats = tracked.get('seats', None)
+        curr_seats = section.seats
+        prev_instructor = tracked.get('instructor', None)
+        curr_instructor = section.instructor
 
-            if 'settings' not in user:
-                logging.warning(f'User {uid} does not have settings field, skipping')
-                continue
+        if prev_seats != curr_seats:
+            self.writer.set(f'sections/{self.term}/{crn}/seats', curr_seats)
+            tracked['seats'] = curr_seats
+            registry.inc('tracker_changes_total', kind='seats')
+            if prev_seats is not None:
+                self.create_seats_noti(section, prev_seats, curr_seats)
 
-            tracking = user['settings']['notificationModes'].get('instructors', False)
-            if not tracking: continue
+        if prev_instructor != curr_instructor:
+            self.writer.set(f'sections/{self.term}/{crn}/instructor', curr_instructor)
+            tracked['instructor'] = curr_instructor
+            registry.inc('tracker_changes_total', kind='instructor')
+            if prev_instructor is not None:
+                self.create_instructor_noti(section, prev_instructor, curr_instructor)
 
+        return prev_seats != curr_seats or prev_instructor != curr_instructor
 
-            methods = user['methods']
-            generate_instructor_web(uid, section, previous, current)
+    def forget_dropped(self):
+        # Sections the listener or a shard sync removed shouldn't be served from the cache if they come back
+        if self.state:
+            for crn in self.state.take_dropped():
+                self.response_cache.forget(crn)
 
-            if methods['discord']['enabled']:
-                webhook_url = methods['discord']['value']
-                notification = InstructorNotification(section, previous, current, NotiType.DISCORD, webhook_url)
-                self.add_notification(notification)
+    def create_seats_noti(self, section: Section, previous, current):
+        audit_log.info('Detected seats change in section %s, from %s to %s', section.crn, previous, current)
+        event = seats_event(previous, current)
+        if event:
+            self.fan_out(section, previous, current, event, SeatNotification, generate_seat_web)
 
-            if methods['phone']['enabled']:
-                phone_number = methods['phone']['value']
-                notification = InstructorNotification(section, previous, current, NotiType.TEXT, phone_number)
-                self.add_notification(notification)
+    def create_instructor_noti(self, section: Section, previous, current):
+        audit_log.info('Detected instructor change in section %s, from %s to %s', section.crn, previous, current)
+        self.fan_out(section, previous, current, INSTRUCTOR, InstructorNotification, generate_instructor_web)
 
-            if methods['email']['enabled']:
-                email_address = methods['email']['value']
-                notification = InstructorNotification(section, previous, current, NotiType.EMAIL, email_address)
-                self.add_notification(notification)
+    def fan_out(self, section: Section, previous, current, event, notification_class, generate_web):
+        for uid, targets in self.subscribers.plan(section.crn, event):
+            generate_web(self.writer, uid, section, previous, current)
+            for noti_type, destination in targets:
+                self.add_notification(notification_class(section, previous, current, noti_type, destination))
 
     def add_notification(self, notification):
         if (notification.to_tuple() not in self.seen):
             self.seen.add(notification.to_tuple())
             self.notifications.append(notification)
-            
-    def send_notifications(self):
-        for notification in self.notifications:
-            notification.send()
+            self.dispatcher.submit(notification)
+
+    def clear_notifications(self):
+        self.seen.clear()
+        self.notifications.clear()
 
     
-def main():
-    init_logging()
-    monitor = SectionMonitor(CURRENT_TERM)
-    crns = list(monitor.sections.keys())
-    batches = split_list(crns, BATCH_SIZE)
+def run(monitor: SectionMonitor):
+    crns = monitor.crns
     start_time = time.time()
     
     logging.info(f'Beginning new run / {len(crns)} sections')
+    registry.reset()
+    monitor.response_cache.reset_stats()
+    if monitor.host_limits:
+        monitor.host_limits.reset_stats()
+    monitor.forget_dropped()
     
     async def monitor_sections(crns):
-        tasks = [monitor.check_change(crn) for crn in crns]
-        await asyncio.gather(*tasks)
+        await monitor.open_session()
+        try:
+            if bulk:
+                await monitor.load_howdy_index()
+            await monitor.check_sections(crns)
+            await monitor.writer.flush_async()
+            with registry.timer('tracker_stage_seconds', stage='notify_drain'):
+                await monitor.dispatcher.drain()
+        finally:
+            await monitor.close_session()
 
     try:
-        for batch in batches:
-            start_batch_time = time.time()
-            asyncio.run(monitor_sections(batch))
-            logging.info(f'Checked batch {batch} in {time.time() - start_batch_time:.2f} secs')
-        monitor.send_notifications()
+        asyncio.run(monitor_sections(crns))
     except Exception as e:
-        logging.exception(f'Exception raised while running batch: {e}')
+        logging.exception(f'Exception raised while running sections: {e}')
         requests.post(CONSOLE_URL, json=error_embed(e))
         time.sleep(10) # If error, wait 10 seconds before continuing
     
     runtime = time.time() - start_time
-    logging.info(f'RUN FINISHED: {runtime:.2f} secs / {len(crns)} sections | {len(crns) / runtime:.2f} sections / sec | {BATCH_SIZE} batch size')
+    logging.info(f'RUN FINISHED: {runtime:.2f} secs / {len(crns)} sections | {len(crns) / runtime:.2f} sections / sec | {MAX_CONCURRENCY} concurrency')
+    logging.info(f'Latency per section: {latency_summary(monitor.latencies)}')
+    logging.info(f'Notifications: {monitor.dispatcher.summary()}')
+    logging.info(f'Connections: {monitor.connection_stats}')
+    logging.info(f'Fetch cache: {monitor.response_cache}')
+    logging.info(f'Host limits: {monitor.host_limits}')
+    logging.info(f'Stages: {registry.stage_summary("tracker_stage_seconds")}')
+    logging.info(f'Requests: {registry.stage_summary("tracker_fetch_seconds")}')
+    registry.dump()
+
+def run_forever():
+    init_firebase()
+    state = create_state(CURRENT_TERM)
+    state.load()
+    state.listen()
+    response_cache = ResponseCache()
+    # Keep what the limiters learned about each host between passes
+    host_limits = HostLimits()
+    # Tracked seats are updated before the flush, so a batch that failed to write must survive into the next pass
+    writer = DatabaseWriter()
+
+    try:
+        while True:
+            run(SectionMonitor(CURRENT_TERM, state, response_cache, host_limits, writer))
+            if sharded:
+                state.refresh_if_due()
+            state.save_if_due()
+            time.sleep(PASS_INTERVAL)
+    finally:
+        state.close()
+        state.save()
+
+def main():
+    init_logging()
+    if long_running:
+        run_forever()
+    elif sharded:
+        if not SHARD_COUNT:
+            # The worker exits after every pass and leaves the ring, so heartbeats can't describe who is running
+            logging.error('One-shot sharded mode needs a fixed SHARD_COUNT, or run with LONG_RUNNING_MODE or the daemon')
+            return
+        init_firebase()
+        state = create_state(CURRENT_TERM)
+        state.load()
+        try:
+            run(SectionMonitor(CURRENT_TERM, state))
+        finally:
+            state.close()
+    else:
+        run(SectionMonitor(CURRENT_TERM))
 
 if __name__ == '__main__':
     main()
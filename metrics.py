@@ -0,0 +1,194 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from aiohttp import web
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+# Port for the Prometheus text endpoint in daemon mode, and a file for the per-run JSON dump
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_PATH = os.getenv('METRICS_PATH', '')
+
+# Upper bounds in seconds, roughly matching the Prometheus client defaults
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+def latency_summary(values):
+    p50, p95, p99 = (percentile(values, p) * 1000 for p in (50, 95, 99))
+    return f'p50 {p50:.0f} ms / p95 {p95:.0f} ms / p99 {p99:.0f} ms'
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+def format_labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+def format_bound(bound):
+    return '+Inf' if bound == float('inf') else f'{bound:g}'
+
+class MetricsRegistry:
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        # Firebase flushes observe from a worker thread
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time, **labels)
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+            self.started = time.time()
+
+    def render(self) -> str:
+        # Prometheus text exposition format
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            histograms = sorted(self.histograms.items())
+
+        typed = set()
+        for metric_type, metrics in (('counter', counters), ('gauge', gauges)):
+            for (name, labels), value in metrics:
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f'# TYPE {name} {metric_type}')
+                lines.append(f'{name}{format_labels(labels)} {value}')
+
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} histogram')
+            for bound, total in histogram.cumulative():
+                lines.append(f'{name}_bucket{format_labels(labels, le=format_bound(bound))} {total}')
+            lines.append(f'{name}_sum{format_labels(labels)} {histogram.sum:.6f}')
+            lines.append(f'{name}_count{format_labels(labels)} {histogram.count}')
+
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            histograms = sorted(self.histograms.items())
+
+        return {
+            'started': self.started,
+            'finished': time.time(),
+            'counters': [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in counters],
+            'gauges': [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in gauges],
+            'histograms': [{
+                'name': name,
+                'labels': dict(labels),
+                'count': histogram.count,
+                'sum': histogram.sum,
+                'p50': histogram.quantile(0.5),
+                'p95': histogram.quantile(0.95),
+                'p99': histogram.quantile(0.99),
+                'buckets': {format_bound(bound): total for bound, total in histogram.cumulative()}
+            } for (name, labels), histogram in histograms]
+        }
+
+    def dump(self, path=METRICS_PATH):
+        if not path:
+            return
+
+        with open(path, 'w') as file:
+            json.dump(self.snapshot(), file, indent=2)
+        logging.info(f'Wrote run metrics to {path}')
+
+    def stage_summary(self, name) -> str:
+        with self.lock:
+            histograms = sorted((labels, histogram) for (metric, labels), histogram in self.histograms.items() if metric == name)
+
+        return ', '.join(
+            f'{"/".join(str(value) for _, value in labels) or name} {histogram.count} x {histogram.sum / histogram.count * 1000:.0f} ms avg'
+            for labels, histogram in histograms if histogram.count
+        ) or 'none'
+
+registry = MetricsRegistry()
+
+async def start_metrics_server(port=METRICS_PORT, metrics: MetricsRegistry = registry):
+    if not port:
+        return None
+
+    async def handle(request):
+        return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', port).start()
+    logging.info(f'Serving metrics on port {port}')
+    return runner
@@ -1,37 +1,39 @@
 from datetime import datetime
-import requests
-from twilio.rest import Client
+import asyncio
+import time
+import json
+import aiohttp
 import os
 from dotenv import load_dotenv
 from embed import seats_embed, instructor_embed
+from section import Section
+from webhooks import WebhookQueue, DISCORD_MAX_EMBEDS
+from sms import send_sms
+from metrics import registry
 import logging
-from firebase_admin import db
+from writer import DatabaseWriter
 
 from enum import Enum
 
 load_dotenv(override=True)
 
-# Twilio keys
-ACCOUNT_SID = os.getenv(
-    'ACCOUNT_SID')
-AUTH_TOKEN = os.getenv('AUTH_TOKEN')
-PHONE_NUMBER = os.getenv('PHONE_NUMBER')
+audit_log = logging.getLogger('tracker.sections.audit')
+
+SMS_MAX_LENGTH = 1600
 
 # Mailgun keys
 MAILGUN_API_KEY = os.getenv('MAILGUN_API_KEY')
 MAILGUN_API_URL = "https://api.mailgun.net/v3/email.aggieseek.net/messages"
 FROM_EMAIL_ADDRESS = "AggieSeek <no-reply@email.aggieseek.net>"
+MAILGUN_BATCH_SIZE = 1000
+EMAIL_MAX_RETRIES = int(os.getenv('EMAIL_MAX_RETRIES', '3'))
+EMAIL_BACKOFF = float(os.getenv('EMAIL_BACKOFF', '0.5'))
 
 PRODUCTION_MODE = os.getenv('PRODUCTION_MODE', 'off')
 
 production = PRODUCTION_MODE == 'on'
 print(f'You are running in {"production" if production else "development"} mode.')
 
-
-twilio_client = Client(ACCOUNT_SID, AUTH_TOKEN)
-twilio_logger = logging.getLogger('twilio.http_client')
-twilio_logger.setLevel(logging.DEBUG)
-
 def get_keyword(prev, curr):
     if prev <= 0 < curr:
         keyword = "✅", "opened"
@@ -46,123 +48,210 @@ def get_keyword(prev, curr):
 
     return keyword
 
+class MailgunError(Exception):
+    pass
+
 class NotiType(Enum):
     TEXT, DISCORD, EMAIL = range(3)
 
 class Notification:
-    def __init__(self, section: dict, previous, current, noti_type: NotiType, destination: str):
+    def __init__(self, section: Section, previous, current, noti_type: NotiType, destination: str):
         self.section = section
         self.previous = previous
         self.current = current
         self.type = noti_type
         self.destination = destination
+        self.created = time.perf_counter()
 
     def to_tuple(self):
-        return (self.section['CRN'], self.previous, self.current, self.type, self.destination)
-
-    def send(self):
-        if self.type == NotiType.TEXT:
-            message = self.generate_text()
-            self.send_text(message)
-        elif self.type == NotiType.DISCORD:
-            embed = self.generate_discord()
-            self.send_discord(embed)
-        elif self.type == NotiType.EMAIL:
-            pass
-            # subject, message = self.generate_email()
-            # self.send_email(subject, message)
-
-    def send_text(self, message):
-        course = self.section['SUBJECT_CODE'] + " " + self.section['COURSE_NUMBER']
-        logging.info(f'Sending text message to {self.destination} for {self.section['CRN']} / {course}')
-        if not production: return
+        return (self.section.crn, self.previous, self.current, self.type, self.destination)
 
-        message = twilio_client.messages.create(
-            from_=PHONE_NUMBER,
-            body=message,
-            to=self.destination
-        )
+    def describe(self):
+        course = self.section.course
+        return f'{self.section.crn} / {course}'
 
-        return message.sid
+    def coalesce_key(self):
+        # Emails are batched across recipients of the same event, other channels per destination
+        if self.type == NotiType.EMAIL:
+            return (self.type, type(self).__name__) + self.to_tuple()[:3]
+        return (self.type, self.destination)
 
-    def send_email(self, subject, message):
-        course = self.section['SUBJECT_CODE'] + " " + self.section['COURSE_NUMBER']
-        logging.info(f'Sending email to {self.destination} for {self.section['CRN']} / {course}')
-        if not production: return
+    def recipients(self):
+        return [self.destination]
 
+    async def send(self, session: aiohttp.ClientSession, webhook: WebhookQueue = None):
+        channel = self.type.name.lower()
         try:
-            post_request = requests.post(MAILGUN_API_URL, auth=("api", MAILGUN_API_KEY),
-                                        data={
-                                            "from": FROM_EMAIL_ADDRESS,
-                                            "to": self.destination,
-                                            "subject": subject,
-                                            "text": message
-                                        })
-            if post_request.status_code == 200:
-                logging.info(f'Successfully sent an email to {self.destination} via Mailgun API.')
-            else:
-                logging.error(f'Could not send the email to {self.destination}, reason: {post_request.text}')
-        except Exception as ex:
-            logging.exception(f'Mailgun error: {ex}')
-
-    def send_discord(self, embed):
-        course = self.section['SUBJECT_CODE'] + " " + self.section['COURSE_NUMBER']
-        logging.info(f'Sending discord message to {self.destination} for {self.section['CRN']} / {course}')
+            with registry.timer('tracker_notification_seconds', channel=channel):
+                if self.type == NotiType.TEXT:
+                    message = self.generate_text()
+                    result = await self.send_text(session, message)
+                elif self.type == NotiType.DISCORD:
+                    result = await (webhook or WebhookQueue(self.destination, session)).send(self)
+                elif self.type == NotiType.EMAIL:
+                    subject, message = self.generate_email()
+                    result = await self.send_email(session, subject, message)
+        except Exception:
+            registry.inc('tracker_notifications_total', channel=channel, outcome='failed')
+            raise
+
+        registry.inc('tracker_notifications_total', channel=channel, outcome='sent')
+        return result
+
+    async def send_text(self, session: aiohttp.ClientSession, message):
+        audit_log.info('Sending text message to %s for %s', self.destination, self.describe())
         if not production: return
-    
-        post_request = requests.post(self.destination, json=embed)
-        status_code = post_request.status_code
 
-        return status_code
+        start_time = time.perf_counter()
+        sid = await send_sms(session, self.destination, message)
+        audit_log.info('Sent text message %s to %s in %.0f ms', sid, self.destination, (time.perf_counter() - start_time) * 1000)
+
+        return sid
+
+    async def send_email(self, session: aiohttp.ClientSession, subject, message):
+        recipients = self.recipients()
+        audit_log.info('Sending email to %d recipients for %s', len(recipients), self.describe())
+        if not production: return
+
+        # recipient-variables makes Mailgun deliver one message per recipient instead of one shared thread
+        data = [('from', FROM_EMAIL_ADDRESS), ('subject', subject), ('text', message)]
+        data += [('to', recipient) for recipient in recipients]
+        data.append(('recipient-variables', json.dumps({recipient: {} for recipient in recipients})))
+
+        for attempt in range(EMAIL_MAX_RETRIES + 1):
+            retry_after = EMAIL_BACKOFF * 2 ** attempt
+
+            try:
+                async with session.post(MAILGUN_API_URL, auth=aiohttp.BasicAuth('api', MAILGUN_API_KEY), data=data) as response:
+                    if response.status == 200:
+                        audit_log.info('Successfully sent an email to %d recipients via Mailgun API.', len(recipients))
+                        return response.status
+
+                    if response.status != 429 and response.status < 500:
+                        raise MailgunError(f'Mailgun rejected the email to {len(recipients)} recipients: {response.status} {await response.text()}')
+
+                    retry_after = float(response.headers.get('Retry-After', retry_after))
+            except aiohttp.ClientError as e:
+                logging.warning(f'Could not reach Mailgun for {len(recipients)} recipients: {e}')
+
+            if attempt == EMAIL_MAX_RETRIES:
+                break
+
+            logging.warning(f'Retrying email to {len(recipients)} recipients in {retry_after:.2f} secs (attempt {attempt + 1})')
+            await asyncio.sleep(retry_after)
+
+        raise MailgunError(f'Gave up sending email to {len(recipients)} recipients after {EMAIL_MAX_RETRIES} retries')
 
 class SeatNotification(Notification):
     def generate_text(self):
         emoji, text = get_keyword(self.previous, self.current)
-        course = self.section['SUBJECT_CODE'] + " " + self.section['COURSE_NUMBER']
-        return f"{emoji} {course} / {self.section['COURSE_TITLE']} / {self.section['CRN']}\n{self.section['INSTRUCTOR']} {text}!\n{self.previous} -> {self.current}"
+        course = self.section.course
+        return f"{emoji} {course} / {self.section.title} / {self.section.crn}\n{self.section.instructor} {text}!\n{self.previous} -> {self.current}"
     
     def generate_discord(self):
         return seats_embed(self.section, self.previous, self.current)
     
     def generate_email(self):
-        pass
+        emoji, text = get_keyword(self.previous, self.current)
+        course = self.section.course
+        return f"{emoji} {course} / {self.section.crn} {text}", self.generate_text()
 
 class InstructorNotification(Notification):
     def generate_text(self):
-        course = self.section['SUBJECT_CODE'] + " " + self.section['COURSE_NUMBER']
-        return f"{course} / {self.section['COURSE_TITLE']} / {self.section['CRN']}\nInstructor has changed!\n{self.previous} -> {self.current}"
+        course = self.section.course
+        return f"{course} / {self.section.title} / {self.section.crn}\nInstructor has changed!\n{self.previous} -> {self.current}"
     
     def generate_discord(self):
         return instructor_embed(self.section, self.previous, self.current)
 
     def generate_email(self):
-        pass
+        course = self.section.course
+        return f"{course} / {self.section.crn} instructor changed", self.generate_text()
+
+class DigestNotification(Notification):
+    def __init__(self, notifications: list):
+        first = notifications[0]
+        super().__init__(first.section, first.previous, first.current, first.type, first.destination)
+        self.notifications = notifications
+        self.created = min(notification.created for notification in notifications)
+
+    def to_tuple(self):
+        return tuple(notification.to_tuple() for notification in self.notifications)
+
+    def describe(self):
+        return f'{len(self.notifications)} sections ({", ".join(notification.section.crn for notification in self.notifications)})'
+
+    def generate_text(self):
+        return '\n\n'.join(notification.generate_text() for notification in self.notifications)
+
+    def generate_discord(self):
+        payload = self.notifications[0].generate_discord()
+        embeds = [embed for notification in self.notifications for embed in notification.generate_discord()['embeds']]
+        return {**payload, 'embeds': embeds}
+
+class EmailBatch(Notification):
+    def __init__(self, notifications: list):
+        first = notifications[0]
+        super().__init__(first.section, first.previous, first.current, first.type, first.destination)
+        self.notifications = notifications
+        self.created = min(notification.created for notification in notifications)
+
+    def to_tuple(self):
+        return tuple(notification.to_tuple() for notification in self.notifications)
+
+    def recipients(self):
+        return [notification.destination for notification in self.notifications]
+
+    def generate_email(self):
+        return self.notifications[0].generate_email()
+
+def coalesce(notifications: list) -> list:
+    # Group notifications sharing a coalesce key into as few messages as each channel allows
+    if len(notifications) <= 1:
+        return notifications
+
+    if notifications[0].type == NotiType.EMAIL:
+        return [EmailBatch(notifications[i:i + MAILGUN_BATCH_SIZE]) for i in range(0, len(notifications), MAILGUN_BATCH_SIZE)]
+
+    chunks, chunk, size = [], [], 0
+    for notification in notifications:
+        if notification.type == NotiType.DISCORD:
+            weight, limit = len(notification.generate_discord()['embeds']), DISCORD_MAX_EMBEDS
+        else:
+            weight, limit = len(notification.generate_text()) + 2, SMS_MAX_LENGTH
+
+        if chunk and size + weight > limit:
+            chunks.append(chunk)
+            chunk, size = [], 0
+        chunk.append(notification)
+        size += weight
+    chunks.append(chunk)
+
+    return [chunk[0] if len(chunk) == 1 else DigestNotification(chunk) for chunk in chunks]
 
-def generate_seat_web(uid, section, previous, current):
+def generate_seat_web(writer: DatabaseWriter, uid, section: Section, previous, current):
     if not production: return
 
     timestamp = datetime.strftime(datetime.utcnow(), '%Y-%m-%dT%H:%M:%SZ')
-    db_ref = db.reference(f'users/{uid}/notifications/{timestamp} {section["CRN"]}')
 
-    db_ref.set({
-        'title': section['SUBJECT_CODE'] + " " + section['COURSE_NUMBER'],
+    writer.set(f'users/{uid}/notifications/{timestamp} {section.crn}', {
+        'title': section.course,
         'timestamp': timestamp,
-        'crn': section['CRN'],
+        'crn': section.crn,
         'message': f'Seats {get_keyword(previous, current)[1]}',
         'origSeats': previous,
         'newSeats': current
     })
 
-def generate_instructor_web(uid, section, previous, current):
+def generate_instructor_web(writer: DatabaseWriter, uid, section: Section, previous, current):
     if not production: return
 
     timestamp = datetime.strftime(datetime.utcnow(), '%Y-%m-%dT%H:%M:%SZ')
-    db_ref = db.reference(f'users/{uid}/notifications/{timestamp} {section["CRN"]}')
 
-    db_ref.set({
-        'title': section['SUBJECT_CODE'] + " " + section['COURSE_NUMBER'],
+    writer.set(f'users/{uid}/notifications/{timestamp} {section.crn}', {
+        'title': section.course,
         'timestamp': timestamp,
-        'crn': section['CRN'],
+        'crn': section.crn,
         'message': f'Instructor changed',
         'origSeats': previous,
         'newSeats': current
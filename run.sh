@@ -1,6 +1,11 @@
 #!/bin/bash
 
+ENTRYPOINT=main.py
+if [ "$DAEMON_MODE" = "on" ]; then
+    ENTRYPOINT=daemon.py
+fi
+
 while true; do
-    python main.py
+    python $ENTRYPOINT
     sleep 8
-done
\ No newline at end of file
+done
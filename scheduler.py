@@ -0,0 +1,95 @@
+import heapq
+import math
+import os
+import time
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+# Poll intervals in seconds; each section's interval is scaled from the base and clamped to these bounds
+MIN_POLL_INTERVAL = float(os.getenv('MIN_POLL_INTERVAL', '5'))
+BASE_POLL_INTERVAL = float(os.getenv('BASE_POLL_INTERVAL', '30'))
+MAX_POLL_INTERVAL = float(os.getenv('MAX_POLL_INTERVAL', '300'))
+
+NEAR_FULL_SEATS = int(os.getenv('NEAR_FULL_SEATS', '5'))
+WIDE_OPEN_SEATS = int(os.getenv('WIDE_OPEN_SEATS', '30'))
+RECENT_CHANGE_WINDOW = float(os.getenv('RECENT_CHANGE_WINDOW', '900'))
+IDLE_AFTER = float(os.getenv('IDLE_AFTER', '7200'))
+
+def poll_interval(section: dict, since_change: float = None) -> float:
+    if not section:
+        return MAX_POLL_INTERVAL
+
+    seats = section.get('seats', None)
+    watchers = len(section.get('users') or {})
+    interval = BASE_POLL_INTERVAL
+
+    if seats is None:
+        return MIN_POLL_INTERVAL
+    elif seats <= NEAR_FULL_SEATS:
+        interval *= 0.25
+    elif seats >= WIDE_OPEN_SEATS:
+        interval *= 4
+
+    if since_change is not None and since_change < RECENT_CHANGE_WINDOW:
+        interval *= 0.5
+    elif since_change is not None and since_change > IDLE_AFTER:
+        interval *= 2
+
+    interval /= 1 + math.log2(max(watchers, 1))
+
+    return min(MAX_POLL_INTERVAL, max(MIN_POLL_INTERVAL, interval))
+
+class PollScheduler:
+    def __init__(self):
+        self.heap = []
+        self.due = {}
+        self.last_change = {}
+        self.in_flight = set()
+        self.polls = 0
+
+    def sync(self, crns):
+        now = time.monotonic()
+        crns = set(crns)
+
+        for crn in crns - self.due.keys() - self.in_flight:
+            # Sections we have not seen change yet start out neither recent nor idle
+            self.last_change.setdefault(crn, now - RECENT_CHANGE_WINDOW)
+            self.schedule(crn, now)
+
+        for crn in self.due.keys() - crns:
+            del self.due[crn]
+            self.last_change.pop(crn, None)
+
+    def schedule(self, crn, due):
+        self.due[crn] = due
+        heapq.heappush(self.heap, (due, crn))
+
+    def next_crn(self):
+        now = time.monotonic()
+        while self.heap and self.heap[0][0] <= now:
+            due, crn = heapq.heappop(self.heap)
+            # Skip heap entries left behind by a reschedule or removal
+            if self.due.get(crn) != due:
+                continue
+            del self.due[crn]
+            self.in_flight.add(crn)
+            self.polls += 1
+            return crn
+        return None
+
+    def reschedule(self, crn, section: dict, changed: bool):
+        now = time.monotonic()
+        self.in_flight.discard(crn)
+
+        if changed:
+            self.last_change[crn] = now
+        since_change = now - self.last_change.get(crn, now - RECENT_CHANGE_WINDOW)
+
+        if section is not None:
+            self.schedule(crn, now + poll_interval(section, since_change))
+
+    def time_until_next(self):
+        if not self.heap:
+            return MAX_POLL_INTERVAL
+        return max(0.0, self.heap[0][0] - time.monotonic())
@@ -1,76 +1,394 @@
-from bs4 import BeautifulSoup
 import aiohttp
+import asyncio
+from contextlib import nullcontext
+from urllib.parse import urlsplit
 import logging
+import hashlib
 import json
+import os
+import re
+import time
+from dataclasses import dataclass, replace
+from typing import NamedTuple
+from dotenv import load_dotenv
+from metrics import registry
+from limiter import AdaptiveLimiter, CircuitOpenError, Permit
 
-# GPT written helper
-def recursive_parse_json(json_str):
-    try:
-        # Try parsing the string as JSON
-        parsed = json.loads(json_str)
-        
-        # If it's a dictionary, recursively parse its values
-        if isinstance(parsed, dict):
-            return {k: recursive_parse_json(v) for k, v in parsed.items()}
-        # If it's a list, recursively parse each element
-        elif isinstance(parsed, list):
-            return [recursive_parse_json(element) for element in parsed]
-        else:
-            return parsed
-    except (json.JSONDecodeError, TypeError):
-        # If parsing fails, return the original string
-        return json_str
-
-def parse_soup(soup: BeautifulSoup) -> dict:
-    all_fields = soup.find_all('td', class_='dddefault')
-
-    if len(all_fields) == 0:
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+load_dotenv(override=True)
+
+# Connection pool tuning for the shared session
+CONNECTION_LIMIT = int(os.getenv('CONNECTION_LIMIT', '100'))
+CONNECTION_LIMIT_PER_HOST = int(os.getenv('CONNECTION_LIMIT_PER_HOST', '50'))
+KEEPALIVE_TIMEOUT = float(os.getenv('KEEPALIVE_TIMEOUT', '30'))
+DNS_CACHE_TTL = int(os.getenv('DNS_CACHE_TTL', '300'))
+REQUEST_TIMEOUT = float(os.getenv('REQUEST_TIMEOUT', '30'))
+CONNECT_TIMEOUT = float(os.getenv('CONNECT_TIMEOUT', '10'))
+
+# Bulk mode pulls Howdy details and instructors once per term (or per subject in BULK_SUBJECTS)
+BULK_MODE = os.getenv('BULK_MODE', 'off')
+BULK_SUBJECTS = [subject.strip() for subject in os.getenv('BULK_SUBJECTS', '').split(',') if subject.strip()]
+bulk = BULK_MODE == 'on'
+
+HOWDY_API_URL = os.getenv('HOWDY_API_URL', 'https://howdy.tamu.edu/api')
+HOWDY_DETAILS_URL = f'{HOWDY_API_URL}/course-section-details'
+HOWDY_INSTRUCTOR_URL = f'{HOWDY_API_URL}/section-meeting-times-with-profs'
+COMPASS_URL = os.getenv('COMPASS_URL', 'https://compass-ssb.tamu.edu/pls/PROD/bwykschd.p_disp_detail_sched')
+
+# Starting in-flight request limit per upstream host, adjusted at runtime by the adaptive limiter
+HOWDY_CONCURRENCY = int(os.getenv('HOWDY_CONCURRENCY', '25'))
+COMPASS_CONCURRENCY = int(os.getenv('COMPASS_CONCURRENCY', '25'))
+
+section_log = logging.getLogger('tracker.sections')
+
+# A <td> with dddefault as one of its whitespace separated classes, quoted or not
+DDDEFAULT_CELL = re.compile(
+    r'<td\b[^>]*?\sclass\s*=\s*'
+    r'(?:"(?:[^"]*\s)?dddefault(?:\s[^"]*)?"|\'(?:[^\']*\s)?dddefault(?:\s[^\']*)?\'|dddefault(?=[\s/>]))'
+    r'[^>]*>',
+    re.IGNORECASE
+)
+
+class ConnectionStats:
+    def __init__(self):
+        self.requests = 0
+        self.created = 0
+        self.reused = 0
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_request_start(session, context, params):
+            self.requests += 1
+
+        async def on_connection_create_end(session, context, params):
+            self.created += 1
+
+        async def on_connection_reuseconn(session, context, params):
+            self.reused += 1
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace_config
+
+    def reuse_ratio(self) -> float:
+        total = self.created + self.reused
+        return self.reused / total if total else 0.0
+
+    def __str__(self):
+        return f'{self.requests} requests / {self.created} new connections / {self.reused} reused ({self.reuse_ratio():.1%} reuse)'
+
+class HostLimits:
+    def __init__(self, limits: dict = None):
+        if limits is None:
+            limits = {
+                urlsplit(HOWDY_DETAILS_URL).hostname: HOWDY_CONCURRENCY,
+                urlsplit(COMPASS_URL).hostname: COMPASS_CONCURRENCY
+            }
+        self.limiters = {host: AdaptiveLimiter(host, limit) for host, limit in limits.items()}
+
+    def slot(self, url, sample=True):
+        limiter = self.limiters.get(urlsplit(url).hostname)
+        return Permit(limiter, sample) if limiter else nullcontext()
+
+    def reset_stats(self):
+        for limiter in self.limiters.values():
+            limiter.reset_stats()
+
+    def __str__(self):
+        return ' || '.join(str(limiter) for limiter in self.limiters.values())
+
+def limit(host_limits: HostLimits, url, sample=True):
+    return host_limits.slot(url, sample) if host_limits else nullcontext()
+
+def create_session(stats: ConnectionStats = None) -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(
+        limit=CONNECTION_LIMIT,
+        limit_per_host=CONNECTION_LIMIT_PER_HOST,
+        keepalive_timeout=KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=DNS_CACHE_TTL,
+        use_dns_cache=True
+    )
+    timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT, sock_connect=CONNECT_TIMEOUT)
+    trace_configs = [stats.trace_config()] if stats else None
+
+    return aiohttp.ClientSession(connector=connector, timeout=timeout, trace_configs=trace_configs)
+
+def parse_compass_seats(html: str) -> dict:
+    # Same cells as find_all('td', class_='dddefault')[1:4], without building a DOM
+    fields = []
+    for match in DDDEFAULT_CELL.finditer(html):
+        fields.append(match.end())
+        if len(fields) == 4:
+            break
+
+    if len(fields) == 0:
         return {}
 
+    capacity, actual, remaining = (int(html[start:html.index('<', start)]) for start in fields[1:4])
+
     return {
         'SEATS': {
-            'ACTUAL': int(all_fields[2].text),
-            'CAPACITY': int(all_fields[1].text),
-            'REMAINING': int(all_fields[3].text)
+            'ACTUAL': actual,
+            'CAPACITY': capacity,
+            'REMAINING': remaining
         },
     }
 
-async def get_section_info(term, crn):
-    result = {}
-    instructor = 'Not assigned'
-
-    async with aiohttp.ClientSession() as session:
-        howdy_url = f'https://howdy.tamu.edu/api/course-section-details?term={term}&subject=&course=&crn={crn}'
-        compass_url = f'https://compass-ssb.tamu.edu/pls/PROD/bwykschd.p_disp_detail_sched?term_in={term}&crn_in={crn}'
-        instructor_url = 'https://howdy.tamu.edu/api/section-meeting-times-with-profs'
-
-        async with session.get(howdy_url) as response:
-            if response.status != 200:
-                logging.warning(f'Could not fetch CRN {crn} from Howdy.')
-                return {}
-
-            result = await response.json()
-
-            if not result:
-                logging.warning(f'Could not fetch CRN {crn} from Howdy.')
-                return {}
-            
-        async with session.post(instructor_url, json={"term": term, "subject": None, "course": None, "crn": crn}) as response:
-            instructor_result = await response.json()
-            if instructor_result and instructor_result.get('SWV_CLASS_SEARCH_INSTRCTR_JSON', None):
-                unparsed_json = instructor_result['SWV_CLASS_SEARCH_INSTRCTR_JSON']
-                parsed_json = recursive_parse_json(unparsed_json)[0]
-                instructor = parsed_json['NAME'].rstrip('(P)').strip()
-        
-        async with session.get(compass_url) as response:
-            try:
-                soup = BeautifulSoup(await response.text(), 'html.parser')
-                seats = parse_soup(soup)
-
-                result.update(seats)
-            except Exception as e:
-                logging.error(f'Error while parsing CRN {crn} from Compass.')
-                return {}
-
-        result.update({'INSTRUCTOR': instructor})
-        return result
\ No newline at end of file
+class Instructor(NamedTuple):
+    name: str
+    primary: bool
+
+NOT_ASSIGNED = Instructor('Not assigned', False)
+
+def decode_instructor(instructor_result: dict) -> Instructor:
+    # Howdy embeds the instructor list as a JSON string, and only the first entry's NAME is ever shown
+    payload = instructor_result.get('SWV_CLASS_SEARCH_INSTRCTR_JSON') if instructor_result else None
+    if not payload:
+        return NOT_ASSIGNED
+
+    instructors = loads(payload) if isinstance(payload, (str, bytes)) else payload
+    name = str(instructors[0]['NAME'])
+    return Instructor(name.rstrip('(P)').strip(), name.endswith('(P)'))
+
+def parse_instructor(instructor_result: dict) -> str:
+    return decode_instructor(instructor_result).name
+
+@dataclass(frozen=True, slots=True)
+class Section:
+    # The few Howdy fields the tracker reads, instead of the whole response
+    crn: str
+    subject: str
+    course_number: str
+    section_number: str
+    title: str
+    instructor: str = NOT_ASSIGNED.name
+    seats: int = None
+
+    @property
+    def course(self) -> str:
+        return f'{self.subject} {self.course_number}'
+
+def section_from_howdy(details: dict) -> Section:
+    if not details or not details.get('CRN'):
+        return None
+
+    return Section(
+        crn=str(details['CRN']),
+        subject=details.get('SUBJECT_CODE', ''),
+        course_number=str(details.get('COURSE_NUMBER', '')),
+        section_number=str(details.get('SECTION_NUMBER', '')),
+        title=details.get('COURSE_TITLE', '')
+    )
+
+def as_list(result) -> list:
+    if not result:
+        return []
+    return result if isinstance(result, list) else [result]
+
+async def fetch_howdy_index(session: aiohttp.ClientSession, term, subject='', host_limits: HostLimits = None) -> dict[str, Section]:
+    details_url = f'{HOWDY_DETAILS_URL}?term={term}&subject={subject}&course=&crn='
+    scope = subject or f'term {term}'
+
+    # An empty index just sends every CRN down the per-CRN path, so no failure here should end the pass
+    try:
+        status, details, _ = await fetch(session, 'GET', details_url, 'bulk_details', scope, lambda body: as_list(loads(body)), host_limits, sample=False)
+        if status != 200:
+            logging.warning(f'Could not bulk fetch {scope} from Howdy.')
+            return {}
+
+        instructor_json = {"term": term, "subject": subject or None, "course": None, "crn": None}
+        status, instructors, _ = await fetch(session, 'POST', HOWDY_INSTRUCTOR_URL, 'bulk_instructor', scope, lambda body: as_list(loads(body)), host_limits, sample=False, json=instructor_json)
+        if status != 200:
+            # Indexing without instructors would read as every section becoming 'Not assigned'
+            logging.warning(f'Could not bulk fetch instructors for {scope} from Howdy.')
+            return {}
+    except ValueError as e:
+        logging.warning(f'Could not parse the bulk Howdy response for {scope}: {e}')
+        return {}
+
+    names = {str(result.get('SWV_CLASS_SEARCH_CRN', '')): parse_instructor(result) for result in instructors}
+
+    # Sections without an instructor record are left out so they go through the per-CRN lookup instead
+    return {
+        section.crn: replace(section, instructor=names[section.crn])
+        for section in map(section_from_howdy, details)
+        if section and section.crn in names
+    }
+
+async def build_howdy_index(session: aiohttp.ClientSession, term, subjects=None, host_limits: HostLimits = None) -> dict:
+    if not subjects:
+        return await fetch_howdy_index(session, term, host_limits=host_limits)
+
+    index = {}
+    for subject_index in await asyncio.gather(*[fetch_howdy_index(session, term, subject, host_limits) for subject in subjects]):
+        index.update(subject_index)
+    return index
+
+class ResponseCache:
+    def __init__(self):
+        # key -> (etag, last modified, body digest, parsed body)
+        self.entries = {}
+        # crn -> bulk index entry the last result was built from
+        self.sources = {}
+        # crn -> section last returned, for callers to compare against when it comes back unchanged
+        self.results = {}
+        self.not_modified = 0
+        self.hits = 0
+        self.misses = 0
+
+    def conditional_headers(self, key) -> dict:
+        etag, last_modified, _, _ = self.entries.get(key, (None, None, None, None))
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        return headers
+
+    def lookup(self, key, body):
+        entry = self.entries.get(key)
+        digest = hashlib.blake2b(body, digest_size=16).digest()
+
+        if entry and entry[2] == digest:
+            return True, digest, entry[3]
+        return False, digest, None
+
+    def store(self, key, headers, digest, parsed):
+        self.entries[key] = (headers.get('ETag'), headers.get('Last-Modified'), digest, parsed)
+
+    def forget(self, crn):
+        self.sources.pop(crn, None)
+        self.results.pop(crn, None)
+        for key in [key for key in self.entries if key.endswith(f'#{crn}')]:
+            del self.entries[key]
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __str__(self):
+        return f'{self.hits} unchanged / {self.misses} changed ({self.hit_ratio():.1%} hit ratio) | {self.not_modified} not modified'
+
+# Returned by get_section_info when nothing the section was built from has changed since the last fetch
+UNCHANGED = object()
+
+async def fetch(session: aiohttp.ClientSession, method, url, endpoint, crn, parse, host_limits: HostLimits = None, cache: ResponseCache = None, sample=True, **kwargs):
+    key = f'{endpoint}#{crn}'
+    headers = cache.conditional_headers(key) if cache else {}
+
+    wait_start = time.perf_counter()
+    try:
+        async with limit(host_limits, url, sample) as permit:
+            start_time = time.perf_counter()
+            registry.observe('tracker_fetch_wait_seconds', start_time - wait_start, endpoint=endpoint)
+
+            async with session.request(method, url, headers=headers, **kwargs) as response:
+                registry.inc('tracker_fetch_responses_total', endpoint=endpoint, status=response.status)
+                if permit:
+                    permit.status = response.status
+                if cache and response.status == 304 and key in cache.entries:
+                    cache.not_modified += 1
+                    registry.observe('tracker_fetch_seconds', time.perf_counter() - start_time, endpoint=endpoint)
+                    # Answer as if the cached body had been served again
+                    return 200, cache.entries[key][3], True
+
+                if response.status != 200:
+                    registry.observe('tracker_fetch_seconds', time.perf_counter() - start_time, endpoint=endpoint)
+                    return response.status, None, False
+
+                body = await response.read()
+                registry.observe('tracker_fetch_seconds', time.perf_counter() - start_time, endpoint=endpoint)
+                registry.inc('tracker_fetch_bytes_total', len(body), endpoint=endpoint)
+
+        unchanged, digest, parsed = cache.lookup(key, body) if cache else (False, None, None)
+        if not unchanged:
+            with registry.timer('tracker_parse_seconds', endpoint=endpoint):
+                parsed = parse(body)
+        if cache:
+            cache.store(key, response.headers, digest, parsed)
+        return response.status, parsed, unchanged
+    except CircuitOpenError:
+        # The host is being given time to recover, so count this section as not fetched
+        registry.inc('tracker_fetch_rejected_total', endpoint=endpoint)
+        return None, None, False
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        # The limiter has already counted this against the host, so skip the section like a failed status
+        registry.inc('tracker_fetch_errors_total', endpoint=endpoint, error=type(e).__name__)
+        section_log.debug('Request for %s of CRN %s failed: %r', endpoint, crn, e)
+        return None, None, False
+    except Exception as e:
+        registry.inc('tracker_fetch_errors_total', endpoint=endpoint, error=type(e).__name__)
+        raise
+
+async def fetch_howdy_section(session: aiohttp.ClientSession, term, crn, host_limits: HostLimits = None, cache: ResponseCache = None):
+    howdy_url = f'{HOWDY_DETAILS_URL}?term={term}&subject=&course=&crn={crn}'
+
+    status, result, details_unchanged = await fetch(session, 'GET', howdy_url, 'details', crn, lambda body: section_from_howdy(loads(body)), host_limits, cache)
+    if status != 200 or not result:
+        section_log.warning('Could not fetch CRN %s from Howdy.', crn)
+        return None, False
+
+    instructor_json = {"term": term, "subject": None, "course": None, "crn": crn}
+    status, instructor, instructor_unchanged = await fetch(session, 'POST', HOWDY_INSTRUCTOR_URL, 'instructor', crn, lambda body: parse_instructor(loads(body)), host_limits, cache, json=instructor_json)
+    # A failed lookup must not read as 'Not assigned', or every watcher gets a false instructor change
+    if status != 200:
+        section_log.warning('Could not fetch instructor for CRN %s from Howdy.', crn)
+        return None, False
+
+    return replace(result, instructor=instructor), details_unchanged and instructor_unchanged
+
+async def get_section_info(session: aiohttp.ClientSession, term, crn, index: dict = None, host_limits: HostLimits = None, cache: ResponseCache = None) -> Section:
+    if index and str(crn) in index:
+        result = index[str(crn)]
+        howdy_unchanged = cache is not None and cache.sources.get(crn) == result
+        if cache:
+            cache.sources[crn] = result
+    else:
+        result, howdy_unchanged = await fetch_howdy_section(session, term, crn, host_limits, cache)
+        if not result:
+            registry.inc('tracker_sections_total', result='howdy_failed')
+            return None
+
+    compass_url = f'{COMPASS_URL}?term_in={term}&crn_in={crn}'
+
+    try:
+        status, seats, seats_unchanged = await fetch(session, 'GET', compass_url, 'compass', crn, lambda body: parse_compass_seats(body.decode('utf-8', 'replace')), host_limits, cache)
+    except ValueError:
+        section_log.error('Error while parsing CRN %s from Compass.', crn)
+        registry.inc('tracker_sections_total', result='parse_error')
+        return None
+
+    if status != 200:
+        section_log.warning('Could not fetch CRN %s from Compass.', crn)
+        registry.inc('tracker_sections_total', result='compass_failed')
+        return None
+
+    if not seats:
+        section_log.warning('Could not find seats for CRN %s on Compass.', crn)
+        registry.inc('tracker_sections_total', result='no_seats')
+        return None
+
+    if cache:
+        if howdy_unchanged and seats_unchanged and crn in cache.results:
+            cache.hits += 1
+            registry.inc('tracker_sections_total', result='unchanged')
+            return UNCHANGED
+        cache.misses += 1
+
+    registry.inc('tracker_sections_total', result='fetched')
+    section = replace(result, seats=seats['SEATS']['REMAINING'])
+    if cache:
+        cache.results[crn] = section
+    return section
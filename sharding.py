@@ -0,0 +1,188 @@
+import bisect
+import hashlib
+import logging
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from firebase_admin import db
+from state import StateCache
+from subscribers import SubscriberIndex
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+# Sharded mode splits the term's CRNs across tracker processes on a consistent hash ring
+SHARDING_MODE = os.getenv('SHARDING_MODE', 'off')
+WORKER_ID = os.getenv('WORKER_ID') or f'{socket.gethostname()}-{os.getpid()}'
+# A fixed SHARD_COUNT names the workers 0..N-1, otherwise membership comes from heartbeats in the database
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '0'))
+VIRTUAL_NODES = int(os.getenv('VIRTUAL_NODES', '512'))
+WORKERS_PATH = os.getenv('WORKERS_PATH', 'tracker/workers')
+WORKER_TTL = float(os.getenv('WORKER_TTL', '45'))
+SHARD_REFRESH_INTERVAL = float(os.getenv('SHARD_REFRESH_INTERVAL', '15'))
+SHARD_SYNC_INTERVAL = float(os.getenv('SHARD_SYNC_INTERVAL', '60'))
+SHARD_LOAD_CONCURRENCY = int(os.getenv('SHARD_LOAD_CONCURRENCY', '32'))
+sharded = SHARDING_MODE == 'on'
+
+# Section fields written by the worker that owns the CRN rather than by the site
+OWNED_FIELDS = ('seats', 'instructor')
+
+def ring_hash(key) -> int:
+    return int.from_bytes(hashlib.blake2b(str(key).encode(), digest_size=8).digest(), 'big')
+
+class HashRing:
+    def __init__(self, nodes, replicas=VIRTUAL_NODES):
+        points = sorted((ring_hash(f'{node}#{replica}'), node) for node in nodes for replica in range(replicas))
+        self.nodes = frozenset(nodes)
+        self.hashes = [point for point, _ in points]
+        self.owners = [node for _, node in points]
+
+    def owner(self, key):
+        if not self.hashes:
+            return None
+        index = bisect.bisect(self.hashes, ring_hash(key)) % len(self.hashes)
+        return self.owners[index]
+
+class ShardMembership:
+    def __init__(self, worker_id=WORKER_ID, shard_count=SHARD_COUNT):
+        self.worker_id = str(worker_id)
+        self.shard_count = shard_count
+        self.ring = HashRing([self.worker_id])
+        self.last_refresh = 0.0
+        self.stopped = threading.Event()
+
+    def heartbeat(self):
+        if not self.shard_count:
+            db.reference(f'{WORKERS_PATH}/{self.worker_id}').set({'seen': time.time()})
+
+    def start(self):
+        # Heartbeat on our own timer, so a pass longer than WORKER_TTL doesn't drop us from the ring
+        if not self.shard_count:
+            threading.Thread(target=self.keep_alive, daemon=True).start()
+
+    def keep_alive(self):
+        while not self.stopped.wait(WORKER_TTL / 3):
+            try:
+                self.heartbeat()
+            except Exception as e:
+                logging.warning(f'Shard heartbeat for {self.worker_id} failed: {e}')
+
+    def live_workers(self):
+        if self.shard_count:
+            return {str(shard) for shard in range(self.shard_count)}
+
+        now = time.time()
+        workers = db.reference(WORKERS_PATH).get() or {}
+        live = {worker for worker, info in workers.items() if isinstance(info, dict) and now - info.get('seen', 0) <= WORKER_TTL}
+        return live | {self.worker_id}
+
+    def refresh(self) -> bool:
+        # Returns True when workers joined or left and the ring was rebuilt
+        self.heartbeat()
+        self.last_refresh = time.monotonic()
+
+        workers = self.live_workers()
+        if workers == self.ring.nodes:
+            return False
+
+        joined, left = workers - self.ring.nodes, self.ring.nodes - workers
+        self.ring = HashRing(workers)
+        logging.info(f'Shard ring now has {len(workers)} workers (joined: {sorted(joined)}, left: {sorted(left)})')
+        return True
+
+    def owns(self, crn) -> bool:
+        return self.ring.owner(crn) == self.worker_id
+
+    def leave(self):
+        self.stopped.set()
+        if not self.shard_count:
+            db.reference(f'{WORKERS_PATH}/{self.worker_id}').delete()
+
+def fetch_children(path, keys) -> dict:
+    keys = list(keys)
+    if not keys:
+        return {}
+
+    with ThreadPoolExecutor(max_workers=min(SHARD_LOAD_CONCURRENCY, len(keys))) as executor:
+        values = executor.map(lambda key: db.reference(f'{path}/{key}').get(), keys)
+        return {key: value for key, value in zip(keys, values) if value is not None}
+
+class ShardedState(StateCache):
+    def __init__(self, term, membership: ShardMembership = None):
+        # Every start syncs the slice from the database anyway, so a snapshot would only leave user data on disk
+        super().__init__(term, snapshot_path='')
+        self.membership = membership or ShardMembership()
+        self.last_sync = 0.0
+
+    def load(self):
+        self.subscribers = SubscriberIndex(self.sections, self.users)
+        self.membership.refresh()
+        self.membership.start()
+        self.sync()
+
+    def listen(self):
+        # A streaming listener always starts by sending the whole tree, so shards poll their own slice instead
+        pass
+
+    def sync(self):
+        self.apply(*self.fetch_slice())
+
+    def fetch_slice(self):
+        start_time = time.time()
+        crns = db.reference(f'sections/{self.term}').get(shallow=True) or {}
+        sections = fetch_children(f'sections/{self.term}', [crn for crn in crns if self.membership.owns(crn)])
+        uids = {uid for section in sections.values() for uid in (section.get('users') or {})}
+        users = fetch_children('users', uids)
+        return len(crns), sections, users, start_time
+
+    def apply(self, total, sections, users, start_time):
+        # The daemon calls this on the event loop, so checks never see the slice half replaced
+        with self.lock:
+            for crn, section in sections.items():
+                tracked = self.sections.get(crn)
+                if tracked is None:
+                    continue
+
+                # This worker is the only writer of seats for its CRNs, so keep ours over a possibly unflushed copy,
+                # and reuse the dict so a check already in flight still writes into the tracked one
+                for field in [field for field in tracked if field not in section and field not in OWNED_FIELDS]:
+                    del tracked[field]
+                tracked.update({field: value for field, value in section.items() if field not in OWNED_FIELDS or field not in tracked})
+                sections[crn] = tracked
+
+            self.dropped |= self.sections.keys() - sections.keys()
+
+            # Update in place so monitors holding these dicts see the new slice
+            self.sections.clear()
+            self.sections.update(sections)
+            self.users.clear()
+            self.users.update(users)
+            self.subscribers.rebuild()
+
+        self.last_sync = time.monotonic()
+        logging.info(f'Shard {self.membership.worker_id} owns {len(sections)} of {total} sections and {len(users)} users, synced in {time.time() - start_time:.2f} secs')
+
+    def fetch_if_due(self):
+        # Returns a slice for apply() when the ring changed or a sync is due, otherwise None
+        now = time.monotonic()
+        rebalanced = False
+        if now - self.membership.last_refresh >= SHARD_REFRESH_INTERVAL:
+            rebalanced = self.membership.refresh()
+
+        if rebalanced or now - self.last_sync >= SHARD_SYNC_INTERVAL:
+            return self.fetch_slice()
+        return None
+
+    def refresh_if_due(self):
+        fetched = self.fetch_if_due()
+        if fetched:
+            self.apply(*fetched)
+
+    def close(self):
+        super().close()
+        self.membership.leave()
+
+def create_state(term) -> StateCache:
+    return ShardedState(term) if sharded else StateCache(term)
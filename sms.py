@@ -0,0 +1,47 @@
+import asyncio
+import logging
+import os
+import aiohttp
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+# Twilio keys
+ACCOUNT_SID = os.getenv('ACCOUNT_SID')
+AUTH_TOKEN = os.getenv('AUTH_TOKEN')
+PHONE_NUMBER = os.getenv('PHONE_NUMBER')
+
+TWILIO_API_URL = os.getenv('TWILIO_API_URL', 'https://api.twilio.com')
+SMS_MAX_RETRIES = int(os.getenv('SMS_MAX_RETRIES', '3'))
+SMS_BACKOFF = float(os.getenv('SMS_BACKOFF', '0.5'))
+
+class TwilioError(Exception):
+    pass
+
+async def send_sms(session: aiohttp.ClientSession, to, body) -> str:
+    url = f'{TWILIO_API_URL}/2010-04-01/Accounts/{ACCOUNT_SID}/Messages.json'
+    auth = aiohttp.BasicAuth(ACCOUNT_SID, AUTH_TOKEN)
+    data = {'From': PHONE_NUMBER, 'To': to, 'Body': body}
+
+    for attempt in range(SMS_MAX_RETRIES + 1):
+        retry_after = SMS_BACKOFF * 2 ** attempt
+
+        try:
+            async with session.post(url, data=data, auth=auth) as response:
+                if response.status in (200, 201):
+                    return (await response.json())['sid']
+
+                if response.status != 429 and response.status < 500:
+                    raise TwilioError(f'Twilio rejected message to {to}: {response.status} {await response.text()}')
+
+                retry_after = float(response.headers.get('Retry-After', retry_after))
+        except aiohttp.ClientError as e:
+            logging.warning(f'Could not reach Twilio for {to}: {e}')
+
+        if attempt == SMS_MAX_RETRIES:
+            break
+
+        logging.warning(f'Retrying text message to {to} in {retry_after:.2f} secs (attempt {attempt + 1})')
+        await asyncio.sleep(retry_after)
+
+    raise TwilioError(f'Gave up sending text message to {to} after {SMS_MAX_RETRIES} retries')
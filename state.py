@@ -0,0 +1,191 @@
+import json
+import logging
+import os
+import threading
+import time
+from firebase_admin import db
+from subscribers import SubscriberIndex
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+STATE_SNAPSHOT_PATH = os.getenv('STATE_SNAPSHOT_PATH', 'state_snapshot.json')
+STATE_SNAPSHOT_INTERVAL = float(os.getenv('STATE_SNAPSHOT_INTERVAL', '300'))
+
+def apply_event(root, event_type, path, data):
+    parts = [part for part in path.split('/') if part]
+
+    if not parts:
+        if event_type == 'put':
+            # Replace the contents in place so monitors holding this dict see the new tree
+            root.clear()
+            root.update(data if isinstance(data, dict) else {})
+            return root
+        parent, key = None, None
+        target = root
+    else:
+        parent = root
+        for part in parts[:-1]:
+            if not isinstance(parent.get(part), dict):
+                parent[part] = {}
+            parent = parent[part]
+        key = parts[-1]
+        target = parent.get(key)
+
+    if event_type == 'put':
+        if data is None:
+            parent.pop(key, None)
+        else:
+            parent[key] = data
+    elif event_type == 'patch':
+        if not isinstance(target, dict):
+            target = parent[key] = {}
+        for child, value in data.items():
+            apply_event(target, 'put', child, value)
+
+    return root
+
+def changed_children(event):
+    # (key, field) pairs touched by a listen event; key is None when the whole tree was replaced
+    parts = [part for part in event.path.split('/') if part]
+
+    if event.event_type == 'patch':
+        children = [parts + [part for part in key.split('/') if part] for key in (event.data or {})]
+    elif not parts:
+        return [(None, None)]
+    else:
+        children = [parts]
+
+    return [(child[0], child[1] if len(child) > 1 else None) for child in children if child]
+
+class StateCache:
+    def __init__(self, term, snapshot_path=STATE_SNAPSHOT_PATH):
+        self.term = term
+        self.snapshot_path = snapshot_path
+        self.sections = {}
+        self.users = {}
+        self.subscribers = None
+        self.lock = threading.Lock()
+        self.listeners = []
+        self.events = 0
+        self.last_saved = 0.0
+        # CRNs removed by the listener since the monitor last asked
+        self.dropped = set()
+
+    def load(self):
+        if not self.load_snapshot():
+            start_time = time.time()
+            self.sections = db.reference(f'sections/{self.term}/').get() or {}
+            self.users = db.reference('users/').get() or {}
+            logging.info(f'Downloaded {len(self.sections)} sections and {len(self.users)} users in {time.time() - start_time:.2f} secs')
+
+        self.subscribers = SubscriberIndex(self.sections, self.users)
+
+    def load_snapshot(self):
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return False
+
+        try:
+            with open(self.snapshot_path) as file:
+                snapshot = json.load(file)
+        except (OSError, ValueError) as e:
+            logging.warning(f'Could not read state snapshot {self.snapshot_path}: {e}')
+            return False
+
+        if snapshot.get('term') != self.term:
+            logging.info(f'State snapshot is for term {snapshot.get("term")}, ignoring it')
+            return False
+
+        self.sections = snapshot.get('sections') or {}
+        self.users = snapshot.get('users') or {}
+        logging.info(f'Loaded {len(self.sections)} sections and {len(self.users)} users from snapshot')
+        return True
+
+    def dump(self):
+        with self.lock:
+            return json.dumps({'term': self.term, 'sections': self.sections, 'users': self.users})
+
+    def write_snapshot(self, snapshot):
+        temp_path = f'{self.snapshot_path}.tmp'
+        with open(temp_path, 'w') as file:
+            file.write(snapshot)
+        os.replace(temp_path, self.snapshot_path)
+        self.last_saved = time.time()
+
+    def save(self):
+        if self.snapshot_path:
+            self.write_snapshot(self.dump())
+
+    def snapshot_due(self):
+        return bool(self.snapshot_path) and time.time() - self.last_saved >= STATE_SNAPSHOT_INTERVAL
+
+    def save_if_due(self):
+        if self.snapshot_due():
+            self.save()
+
+    def listen(self):
+        self.listeners = [
+            db.reference(f'sections/{self.term}').listen(self.on_sections_event),
+            db.reference('users').listen(self.on_users_event)
+        ]
+
+    def on_sections_event(self, event):
+        self.handle_event(self.apply_sections_event, event)
+
+    def on_users_event(self, event):
+        self.handle_event(self.apply_users_event, event)
+
+    def handle_event(self, apply, event):
+        # firebase_admin calls listeners on its own thread and an exception there silently ends the stream
+        try:
+            apply(event)
+        except Exception as e:
+            logging.exception(f'Exception raised while applying {event.event_type} event at {event.path}: {e}')
+            try:
+                with self.lock:
+                    self.subscribers.rebuild()
+            except Exception as e:
+                logging.exception(f'Could not rebuild subscribers after a bad event: {e}')
+
+    def apply_sections_event(self, event):
+        with self.lock:
+            before = set(self.sections)
+            self.sections = apply_event(self.sections, event.event_type, event.path, event.data)
+            self.events += 1
+
+            # Only subscription changes affect the index, not our own seats/instructor writes
+            for crn, field in changed_children(event):
+                if crn is None:
+                    self.dropped |= before - set(self.sections)
+                    self.subscribers.rebuild()
+                    break
+                if field is None and crn not in self.sections:
+                    self.dropped.add(crn)
+                if field in (None, 'users'):
+                    self.subscribers.update_section(crn)
+
+    def apply_users_event(self, event):
+        with self.lock:
+            self.users = apply_event(self.users, event.event_type, event.path, event.data)
+            self.events += 1
+
+            for uid, field in changed_children(event):
+                if uid is None:
+                    self.subscribers.rebuild()
+                    break
+                if field in (None, 'methods', 'settings'):
+                    self.subscribers.update_user(uid)
+
+    def take_dropped(self) -> set:
+        with self.lock:
+            dropped, self.dropped = self.dropped, set()
+        return dropped
+
+    def crns(self):
+        with self.lock:
+            return list(self.sections.keys())
+
+    def close(self):
+        for listener in self.listeners:
+            listener.close()
+        self.listeners = []
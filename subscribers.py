@@ -0,0 +1,110 @@
+import logging
+from notifications import NotiType
+
+section_log = logging.getLogger('tracker.sections')
+
+OPEN, CLOSE, INSTRUCTOR = 'open', 'close', 'instructor'
+
+# User method field and the channel it delivers to
+CHANNELS = (('discord', NotiType.DISCORD), ('phone', NotiType.TEXT), ('email', NotiType.EMAIL))
+
+def seats_event(previous, current):
+    if previous <= 0 < current:
+        return OPEN
+    if current <= 0 < previous:
+        return CLOSE
+    return None
+
+def compile_user(uid, user):
+    if not user:
+        section_log.debug('User %s does not exist, skipping', uid)
+        return None, ()
+
+    if 'methods' not in user:
+        section_log.debug('User %s does not have methods field, skipping', uid)
+        return None, ()
+
+    if 'settings' not in user:
+        section_log.debug('User %s does not have settings field, skipping', uid)
+        return None, ()
+
+    try:
+        modes = user['settings'].get('notificationModes', {})
+        events = frozenset(event for event, mode in ((OPEN, 'open'), (CLOSE, 'close'), (INSTRUCTOR, 'instructors')) if modes.get(mode, False))
+
+        methods = user['methods']
+        targets = tuple(
+            (noti_type, methods[method]['value'])
+            for method, noti_type in CHANNELS
+            if methods.get(method, {}).get('enabled', False)
+        )
+    except (AttributeError, KeyError, TypeError) as e:
+        section_log.warning('User %s has malformed settings (%r), skipping', uid, e)
+        return None, ()
+
+    return events, targets
+
+class SubscriberIndex:
+    def __init__(self, sections: dict, users: dict):
+        self.sections = sections
+        self.users = users
+        self.users_compiled = {}
+        self.subscriptions = {}
+        self.section_users = {}
+        self.plans = {}
+        self.rebuild()
+
+    def rebuild(self):
+        # Build aside and swap, so plan() called from another thread never sees a half-filled index
+        users_compiled = {uid: compile_user(uid, user) for uid, user in list(self.users.items())}
+        subscriptions = {}
+        section_users = {}
+        plans = {}
+        for crn, section in list(self.sections.items()):
+            if not section:
+                continue
+            uids = tuple((section.get('users') or {}).keys())
+            for uid in uids:
+                subscriptions.setdefault(uid, set()).add(crn)
+            section_users[crn] = uids
+            plans[crn] = self.compile_plan(uids, users_compiled)
+
+        self.users_compiled = users_compiled
+        self.subscriptions = subscriptions
+        self.section_users = section_users
+        self.plans = plans
+
+    def update_section(self, crn):
+        for uid in self.section_users.pop(crn, ()):
+            self.subscriptions.get(uid, set()).discard(crn)
+
+        section = self.sections.get(crn)
+        if not section:
+            self.plans.pop(crn, None)
+            return
+
+        uids = tuple((section.get('users') or {}).keys())
+        for uid in uids:
+            self.subscriptions.setdefault(uid, set()).add(crn)
+        self.section_users[crn] = uids
+        self.plans[crn] = self.compile_plan(uids)
+
+    def update_user(self, uid):
+        self.users_compiled[uid] = compile_user(uid, self.users.get(uid))
+        for crn in self.subscriptions.get(uid, ()):
+            self.plans[crn] = self.compile_plan(self.section_users[crn])
+
+    def compile_plan(self, uids, users_compiled=None):
+        users_compiled = self.users_compiled if users_compiled is None else users_compiled
+        plan = {OPEN: [], CLOSE: [], INSTRUCTOR: []}
+        for uid in uids:
+            if uid not in users_compiled:
+                users_compiled[uid] = compile_user(uid, self.users.get(uid))
+
+            events, targets = users_compiled[uid]
+            for event in events or ():
+                plan[event].append((uid, targets))
+        return plan
+
+    def plan(self, crn, event):
+        return self.plans.get(crn, {}).get(event, ())
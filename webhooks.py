@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from contextlib import nullcontext
+import aiohttp
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+audit_log = logging.getLogger('tracker.sections.audit')
+
+DISCORD_MAX_EMBEDS = 10
+DISCORD_MAX_RETRIES = int(os.getenv('DISCORD_MAX_RETRIES', '5'))
+DISCORD_BACKOFF = float(os.getenv('DISCORD_BACKOFF', '0.5'))
+
+production = os.getenv('PRODUCTION_MODE', 'off') == 'on'
+
+class WebhookError(Exception):
+    pass
+
+class WebhookQueue:
+    def __init__(self, url, session: aiohttp.ClientSession, semaphore: asyncio.Semaphore = None):
+        self.url = url
+        self.session = session
+        self.semaphore = semaphore
+        self.pending = deque()
+        self.worker = None
+
+        # Rate limit bucket reported by Discord on the last response
+        self.remaining = None
+        self.reset_at = 0.0
+
+        self.posts = 0
+        self.retries = 0
+
+    def send(self, notification) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((notification.generate_discord(), future))
+
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.create_task(self.run())
+
+        return future
+
+    async def run(self):
+        while self.pending:
+            payload, future = self.pending.popleft()
+            batch = [future]
+            embeds = list(payload['embeds'])
+
+            # Fold any other queued notifications into the same message, up to Discord's embed limit
+            while self.pending and len(embeds) + len(self.pending[0][0]['embeds']) <= DISCORD_MAX_EMBEDS:
+                next_payload, future = self.pending.popleft()
+                embeds.extend(next_payload['embeds'])
+                batch.append(future)
+
+            try:
+                status = await self.post({**payload, 'embeds': embeds})
+                for future in batch:
+                    future.set_result(status)
+            except Exception as e:
+                for future in batch:
+                    future.set_exception(e)
+
+    async def wait_for_bucket(self):
+        delay = self.reset_at - time.monotonic()
+        if self.remaining == 0 and delay > 0:
+            logging.debug('Webhook %s rate limit exhausted, waiting %.2f secs', self.url, delay)
+            await asyncio.sleep(delay)
+
+    def update_bucket(self, headers):
+        if 'X-RateLimit-Remaining' in headers:
+            self.remaining = int(headers['X-RateLimit-Remaining'])
+        if 'X-RateLimit-Reset-After' in headers:
+            self.reset_at = time.monotonic() + float(headers['X-RateLimit-Reset-After'])
+
+    async def post(self, payload):
+        audit_log.info('Sending discord message to %s with %d embeds', self.url, len(payload['embeds']))
+        if not production: return
+
+        for attempt in range(DISCORD_MAX_RETRIES + 1):
+            await self.wait_for_bucket()
+            retry_after = DISCORD_BACKOFF * 2 ** attempt
+
+            try:
+                async with self.semaphore or nullcontext(), self.session.post(self.url, json=payload) as response:
+                    self.posts += 1
+                    self.update_bucket(response.headers)
+
+                    if response.status == 429:
+                        body = await response.json(content_type=None)
+                        retry_after = float(body.get('retry_after', response.headers.get('Retry-After', retry_after)))
+                    elif response.status < 400:
+                        return response.status
+                    elif response.status < 500:
+                        raise WebhookError(f'Discord rejected message to {self.url}: {response.status} {await response.text()}')
+            except aiohttp.ClientError as e:
+                logging.warning(f'Could not reach webhook {self.url}: {e}')
+
+            if attempt == DISCORD_MAX_RETRIES:
+                break
+
+            self.retries += 1
+            logging.warning(f'Retrying webhook {self.url} in {retry_after:.2f} secs (attempt {attempt + 1})')
+            await asyncio.sleep(retry_after)
+
+        raise WebhookError(f'Gave up sending to {self.url} after {DISCORD_MAX_RETRIES} retries')
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from dotenv import load_dotenv
+from firebase_admin import db
+from metrics import registry
+
+load_dotenv(override=True)
+
+# Flushes a path may fail before it is dropped, so one bad path can't wedge every later update
+DB_MAX_RETRIES = int(os.getenv('DB_MAX_RETRIES', '5'))
+
+class DatabaseWriter:
+    def __init__(self, max_retries=DB_MAX_RETRIES):
+        self.pending = {}
+        # Every proper prefix of a pending path, so finding descendants doesn't scan the batch on each set
+        self.parents = set()
+        # path -> failed flushes, for paths waiting to be retried
+        self.attempts = {}
+        self.max_retries = max_retries
+        self.lock = threading.Lock()
+        self.updates = 0
+        self.paths_written = 0
+
+    def set(self, path, value):
+        with self.lock:
+            self.put(path.strip('/'), value)
+
+    def delete(self, path):
+        with self.lock:
+            self.put(path.strip('/'), None)
+
+    def put(self, path, value):
+        # A multi-path update cannot contain both a path and one of its descendants, so a newer write
+        # replaces pending descendants and is folded into a pending ancestor, which keeps the result the
+        # same as applying each write in order
+        if self.has_descendants(path):
+            for pending_path in [p for p in self.pending if p.startswith(path + '/')]:
+                del self.pending[pending_path]
+
+        ancestor = self.pending_ancestor(path)
+        if ancestor is None:
+            self.pending[path] = value
+            self.parents.update(self.prefixes(path))
+            return
+
+        # Deleting the ancestor then writing below it leaves the ancestor holding just the new value
+        node = self.pending[ancestor] = dict(self.pending[ancestor]) if isinstance(self.pending[ancestor], dict) else {}
+        *parts, key = path[len(ancestor) + 1:].split('/')
+        for part in parts:
+            child = node.get(part)
+            node[part] = dict(child) if isinstance(child, dict) else {}
+            node = node[part]
+        if value is None:
+            node.pop(key, None)
+        else:
+            node[key] = value
+
+    def pending_ancestor(self, path):
+        return next((p for p in self.prefixes(path) if p in self.pending), None)
+
+    def has_descendants(self, path):
+        return path in self.parents and any(p.startswith(path + '/') for p in self.pending)
+
+    @staticmethod
+    def prefixes(path):
+        parts = path.split('/')
+        return ['/'.join(parts[:i]) for i in range(1, len(parts))]
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.parents = set()
+
+        if not pending:
+            return
+
+        start_time = time.time()
+        # Paths that failed before go in their own update, so they can't keep failing the new writes
+        retried = {path: value for path, value in pending.items() if path in self.attempts}
+        fresh = {path: value for path, value in pending.items() if path not in self.attempts}
+        try:
+            db.reference('/').update(fresh or retried)
+        except Exception as e:
+            registry.inc('tracker_db_errors_total', error=type(e).__name__)
+            self.retry(pending, counted=False)
+            raise
+
+        # Only once the database has taken the new writes is a failing retry the fault of its own paths
+        failed = self.write(retried) if fresh and retried else {}
+        for path in retried.keys() - failed.keys():
+            self.attempts.pop(path, None)
+        self.retry(failed)
+
+        written = len(pending) - len(failed)
+        self.updates += 1
+        self.paths_written += written
+        registry.observe('tracker_stage_seconds', time.time() - start_time, stage='db_flush')
+        registry.inc('tracker_db_paths_total', written)
+        logging.info(f'Wrote {written} database paths in {time.time() - start_time:.2f} secs')
+
+    def write(self, updates):
+        # Splits a failing batch in half until the paths that fail on their own are found, and returns them
+        try:
+            db.reference('/').update(updates)
+            return {}
+        except Exception as e:
+            registry.inc('tracker_db_errors_total', error=type(e).__name__)
+            if len(updates) == 1:
+                logging.warning(f'Could not write {next(iter(updates))} to the database: {e}')
+                return updates
+
+        items = list(updates.items())
+        half = len(items) // 2
+        return {**self.write(dict(items[:half])), **self.write(dict(items[half:]))}
+
+    def retry(self, failed, counted=True):
+        # Puts failed paths back for the next flush, without overwriting anything newer
+        dropped = []
+        with self.lock:
+            for path, value in failed.items():
+                attempts = self.attempts.get(path, 0) + counted
+                if attempts > self.max_retries:
+                    self.attempts.pop(path, None)
+                    dropped.append(path)
+                elif path not in self.pending and self.pending_ancestor(path) is None and not self.has_descendants(path):
+                    self.pending[path] = value
+                    self.parents.update(self.prefixes(path))
+                    self.attempts[path] = attempts
+                else:
+                    self.attempts.pop(path, None)
+
+        if dropped:
+            registry.inc('tracker_db_dropped_total', len(dropped))
+            logging.error(f'Dropped {len(dropped)} database paths after {self.max_retries} failed retries: {", ".join(sorted(dropped))}')
+
+    async def flush_async(self):
+        await asyncio.to_thread(self.flush)